@@ -0,0 +1,203 @@
+"""
+Covariate-adjusted group comparisons (ANCOVA). For each prefix the design matrix (one indicator column per category
+plus centred covariates) is built once and factorised once by QR; every output is then a right-hand side of the same
+least squares problem. Outputs are grouped by their pattern of missing rows and each pattern is factorised once, so
+outputs that are missing together (e.g. the Promis-29 scores of one survey) share a factorisation.
+
+With centred covariates the category coefficients are the adjusted means at the covariate means. Adjusted pairwise
+comparisons use the Tukey-Kramer studentized range on the adjusted means and their covariance.
+
+As in do_anova, a patient in several one-hot categories contributes one row per category.
+"""
+__author__ = "Arjit M; amisra2@illinois.edu"
+__version__ = "Feb 2 2024"
+
+import os
+
+import numpy as np
+
+from npa_consts import PREFIX_TO_LABELS, ANCOVA_COVARIATES
+from npa_helpers import getGroupLabels
+from npa_new import find_categories, category_masks, category_label_num
+
+
+def covariate_matrix(data, covariates):
+    """
+    Covariate columns of data: continuous covariates as is, prefixes of PREFIX_TO_LABELS as treatment dummies (first
+    level is the reference). Rows with a missing covariate are nan. Returns matrix and column names.
+    """
+    cols, names = [], []
+    for cov in covariates:
+        x = data[cov].to_numpy(dtype=float)
+        if cov in PREFIX_TO_LABELS:
+            levels = np.unique(x[~np.isnan(x)])
+            for lev in levels[1:]:
+                cols.append(np.where(np.isnan(x), np.nan, x == lev))
+                names.append("{0}={1}".format(cov, int(lev)))
+        else:
+            cols.append(x)
+            names.append(cov)
+    return (np.column_stack(cols) if cols else np.zeros((len(data), 0))), names
+
+
+def _factorise(X, tol=1e-10):
+    """
+    QR of X, dropping covariate columns that are collinear with earlier ones. Returns kept column indices, Q and R.
+    """
+    keep = np.arange(X.shape[1])
+    while True:
+        Q, R = np.linalg.qr(X[:, keep])
+        d = np.abs(np.diag(R))
+        bad = d < tol * max(d.max(), 1)
+        if not bad.any():
+            return keep, Q, R
+        keep = keep[~bad]
+
+
+def fit_ancova(Y, X, k):
+    """
+    Least squares of every column of Y on X, whose first k columns are category indicators. nan in Y marks a
+    missing row of that output. Returns per-output adjusted means, their covariance, residual variance and df.
+    """
+    from scipy import linalg
+
+    m = Y.shape[1]
+    adj = np.full((m, k), np.nan)
+    cov = np.full((m, k, k), np.nan)
+    mse = np.full(m, np.nan)
+    dfe = np.zeros(m)
+    n = np.zeros((m, k))
+
+    ok = ~np.isnan(Y)
+    patterns, which = np.unique(ok.T, axis=0, return_inverse=True)
+    for pi, rows in enumerate(patterns):
+        outs = np.where(which.ravel() == pi)[0]
+        Xp = X[rows]
+        keep, Q, R = _factorise(Xp)
+        if not np.array_equal(keep[:k], np.arange(k)):
+            continue
+
+        # One factorisation, all outputs sharing this missing-row pattern solved together.
+        Yp = Y[np.ix_(rows, outs)]
+        B = linalg.solve_triangular(R, Q.T @ Yp)
+        resid = Yp - Xp[:, keep] @ B
+        Rinv = linalg.solve_triangular(R, np.eye(len(keep)))
+        XtXi = (Rinv @ Rinv.T)[:k, :k]
+
+        df = len(Xp) - len(keep)
+        s2 = np.sum(resid ** 2, axis=0) / df
+        adj[outs] = B[:k].T
+        cov[outs] = s2[:, None, None] * XtXi[None]
+        mse[outs] = s2
+        dfe[outs] = df
+        n[outs] = Xp[:, :k].sum(axis=0)
+    return adj, cov, mse, dfe, n
+
+
+def ancova_tests(adj, cov, dfe, p_thresh=0.05):
+    """
+    Omnibus F test of equal adjusted means and Tukey-Kramer pairwise p-values (only when the omnibus is significant).
+    """
+    from scipy import stats
+
+    k = len(adj)
+    L = np.hstack([-np.ones((k - 1, 1)), np.eye(k - 1)])
+    Lb = L @ adj
+    f = Lb @ np.linalg.solve(L @ cov @ L.T, Lb) / (k - 1)
+    p = stats.f.sf(f, k - 1, dfe)
+
+    i, j = np.triu_indices(k, 1)
+    diff = np.zeros((k, k))
+    diff[i, j] = adj[i] - adj[j]
+    diff[j, i] = -diff[i, j]
+    Pij = np.ones((k, k))
+    if p < p_thresh:
+        se = np.sqrt(cov[i, i] + cov[j, j] - 2 * cov[i, j])
+        Pij[i, j] = Pij[j, i] = stats.studentized_range.sf(np.abs(diff[i, j]) / (se / np.sqrt(2)), k, dfe)
+    return f, p, diff, Pij
+
+
+def do_ancova(var_head, outputs, data, one_hot=True, covariates=ANCOVA_COVARIATES, min_size=15, p_thresh=0.05,
+              result_dir="results_ancova", labels=None):
+    """
+    ANCOVA of every output by the categories of var_head, adjusted for covariates. Writes text and TSV reports laid
+    out as do_anova's, with adjusted means in place of raw means.
+    """
+    outputs = list(outputs)
+    covariates = [c for c in covariates if c != var_head and c in data.columns]
+
+    C, cov_names = covariate_matrix(data, covariates)
+    has_cov = ~np.isnan(C).any(axis=1)
+
+    categories = find_categories(var_head, outputs, data.loc[has_cov], one_hot, min_size)
+    k = len(categories)
+    if k < 2:
+        print("{0} ANCOVA not performed. Insuffucient categories.".format(var_head))
+        return
+
+    # Design over (patient, category) rows: category indicators then covariates centred at their design means.
+    masks = category_masks(var_head, categories, data, one_hot) & has_cov[:, None]
+    pt, grp = np.nonzero(masks)
+    Cs = C[pt]
+    X = np.hstack([np.eye(k)[grp], Cs - Cs.mean(axis=0)])
+    Y = data[outputs].to_numpy(dtype=float)[pt]
+
+    adj, cov, mse, dfe, n = fit_ancova(Y, X, k)
+
+    labeller = labels if labels is not None else PREFIX_TO_LABELS.get(var_head)
+    cat_labs = []
+    outtxt = [var_head + "\n", "Adjusted for: {0}\n".format(", ".join(cov_names)), "=========== Key ===========\n"]
+    for g, C_ in enumerate(categories):
+        lab_num = category_label_num(var_head, C_, one_hot)
+        lab = labeller.get(lab_num, lab_num)
+        cat_labs.append(str(lab))
+        outtxt.append("Group {0}: \t  {1}\n".format(g, lab))
+    outtxt.append('\n')
+    outcsv = ["\t".join([''] + cat_labs + ["ANCOVA"])]
+
+    results = []
+    for o, output in enumerate(outputs):
+        outcsv_row = [output]
+        outtxt.append("\n\n##################################################\n")
+        outtxt.append(output + "\n\n")
+        if not dfe[o] > 0:
+            outtxt.append("Not estimable.\n")
+            outcsv.append("\t".join(outcsv_row + [""] * k + ["not estimable"]))
+            continue
+
+        f, p, diff, Pij = ancova_tests(adj[o], cov[o], dfe[o], p_thresh)
+        se = np.sqrt(np.diag(cov[o]))
+        results.append(dict(output=output, f=f, p=p, adj_mean=adj[o], se=se, n=n[o], diff=diff, Pij=Pij))
+        outtxt.append("p = {0}\nf = {1}\ndf = ({2}, {3})\n\n".format(p, f, k - 1, int(dfe[o])))
+
+        diff_str = ['a' for _ in range(k)]
+        if p < p_thresh:
+            outtxt.append("=========== P Values adjusted Tukey HSD ===========\n")
+            for i in range(k):
+                for j in range(i + 1, k):
+                    outtxt.append("({0}, {1}): {2}\ndiff: {3}\n".format(i, j, Pij[i][j], diff[i][j]))
+            outtxt.append('\n')
+            diff_str = getGroupLabels(Pij < p_thresh)
+
+        outtxt.append('=========== Adjusted Summary ===========\n')
+        for g in range(k):
+            outtxt.append("Group: {0}\nAdjusted mean: {1}\nSE: {2}\nN: {3}\n".format(g, adj[o][g], se[g], int(n[o][g])))
+            outcsv_row.append("{0} ({1}) N={2}".format(round(adj[o][g], 2), diff_str[g], int(n[o][g])))
+        outtxt.append('\n')
+
+        if p < p_thresh:
+            outcsv_row.append("p={0} f={1}".format(round(p, 4), round(f, 2)))
+        else:
+            outcsv_row.append("p>{0}".format(p_thresh))
+        outcsv.append("\t".join(outcsv_row))
+
+    os.makedirs(result_dir, exist_ok=True)
+    with open("{0}/{1}_ancova_tHSD.txt".format(result_dir, var_head), 'w') as outfile:
+        for ln in outtxt:
+            outfile.write(ln)
+
+    with open("{0}/{1}_ancova_tHSD.tsv".format(result_dir, var_head), 'w') as outfile:
+        for ln in outcsv:
+            outfile.write(ln + "\n")
+
+    return results
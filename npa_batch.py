@@ -0,0 +1,186 @@
+"""
+Batch mode over a directory of site exports (npadata_<site>.csv). Every site is run through the same analysis spec
+(npa_spec.json by default) in its own directory, <out>/<site>/, on a pool of worker processes:
+
+    python npa_batch.py exports/ --out results_sites -j 4
+
+Structures derived from constants are built once in the parent and handed to each worker when it starts, not rebuilt
+per site: the parsed spec, the column schema (every export is checked against the first, and the run stops if any
+differs) and the tumor size quantile edges, taken over the pooled sites so that the tumor categories mean the same at
+every site. Each worker returns the
+StatsCube of its site over the output sets and prefixes of the spec's ANOVA analyses; the cubes are merged into
+<out>/pooled.npz, the do_anova tables of the pooled data (<out>/pooled/) and <out>/cross_site_summary.tsv, which
+lists the ANOVA p-value of every output at every site and pooled. Each analysis is pooled with its own min_size and
+p_thresh. Kruskal-Wallis and ANCOVA analyses cannot be pooled from group statistics and are run per site only.
+"""
+__author__ = "Arjit M; amisra2@illinois.edu"
+__version__ = "Feb 2 2024"
+
+import os
+import glob
+import copy
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import npa_helpers
+from npa_consts import TUMOR_VARS, TUMOR_METRICS, TUMOR_METRIC_QUANTILES
+from npa_cube import StatsCube
+from npa_spec import load_spec, run_spec, resolve_analyses
+
+_WORKER = dict()
+
+
+def find_sites(data_dir, pattern="npadata_*.csv"):
+    """
+    {site name: export path}, the site name being the file name after "npadata_".
+    """
+    paths = sorted(glob.glob(os.path.join(data_dir, pattern)))
+    return {os.path.splitext(os.path.basename(p))[0].split("npadata_", 1)[-1]: p for p in paths}
+
+
+def check_schema(sites):
+    """
+    Compare every export's header with the first. Returns {site: (missing columns, extra columns)} of mismatches.
+    """
+    headers = {site: list(pd.read_csv(path, nrows=0).columns) for site, path in sites.items()}
+    ref = headers[next(iter(headers))]
+    return {site: (sorted(set(ref) - set(cols)), sorted(set(cols) - set(ref)))
+            for site, cols in headers.items() if cols != ref}
+
+
+def pooled_bin_edges(sites, metrics=TUMOR_METRICS, q=TUMOR_METRIC_QUANTILES):
+    """
+    Tumor metric quantile edges over the patients of all sites, reading only the tumor columns.
+    """
+    tdfs = [npa_helpers.generateTumorDf(pd.read_csv(path, usecols=TUMOR_VARS + ["pt_study_id"]), path=None)
+            for path in sites.values()]
+    pooled = pd.concat(tdfs)
+    return {m: npa_helpers.quantile_bin_edges(pooled[m].to_numpy(dtype=float), q) for m in metrics}
+
+
+def pooled_analyses(spec):
+    """
+    The spec's ANOVA analyses, which are pooled from the site cubes, and their output sets keyed by result_dir.
+    """
+    analyses = [a for a in resolve_analyses(spec) if a["method"] == "anova"]
+    output_sets = dict()
+    for a in analyses:
+        if output_sets.setdefault(a["result_dir"], a["outputs"]) != a["outputs"]:
+            raise ValueError("ANOVA analyses in {0} have different outputs and cannot be pooled as one output "
+                             "set.".format(a["result_dir"]))
+    return analyses, output_sets
+
+
+def site_spec(spec, site, path, out_root):
+    """
+    Copy of spec reading one site's export and writing under <out_root>/<site>.
+    """
+    site_dir = os.path.join(out_root, site)
+    s = copy.deepcopy(spec)
+    s["data"] = path
+    s["expanded"] = os.path.join(site_dir, "npa_expanded.csv")
+    for analysis in s["analyses"]:
+        analysis["result_dir"] = os.path.join(site_dir, analysis["result_dir"])
+    return s
+
+
+def _init_worker(spec, bin_edges):
+    _WORKER.update(spec=spec, edges=bin_edges)
+
+
+def _run_site(site, path, out_root):
+    spec = site_spec(_WORKER["spec"], site, path, out_root)
+    os.makedirs(os.path.join(out_root, site), exist_ok=True)
+    results = run_spec(spec, workers=1, edges=_WORKER["edges"])
+    adf, prefix_labels, prefix_one_hot, _ = results[("adf", path)]
+
+    analyses, output_sets = pooled_analyses(_WORKER["spec"])
+    prefixes = {v for a in analyses for v in a["prefixes"]}
+    one_hot = {v: h for v, h in prefix_one_hot.items() if v in prefixes}
+    return site, StatsCube.build(adf, output_sets, one_hot), prefix_labels
+
+
+def cross_site_summary(cubes, pooled, analyses):
+    """
+    Rows of (set, prefix, output, p at each site..., pooled f, pooled p, number of sites with p < p_thresh) for every
+    prefix of every pooled analysis, with the analysis' min_size and p_thresh. Sites at which fewer than two
+    categories qualify are left blank.
+    """
+    rows = []
+    for a in analyses:
+        set_name, outputs, min_size, p_thresh = a["result_dir"], a["outputs"], a["min_size"], a["p_thresh"]
+        for var_head in [v for v in a["prefixes"] if v in pooled.prefixes]:
+            site_p = []
+            for cube in cubes.values():
+                p = [np.nan] * len(outputs)
+                if var_head in cube.prefixes:
+                    keys, gc = cube.group_cube(var_head, set_name, min_size)
+                    if len(keys) >= 2:
+                        p = gc.anova()["p"]
+                site_p.append(p)
+
+            keys, gc = pooled.group_cube(var_head, set_name, min_size)
+            if len(keys) < 2:
+                continue
+            res = gc.anova()
+            for o, output in enumerate(outputs):
+                ps = [p[o] for p in site_p]
+                sig = int(np.sum(np.asarray(ps) < p_thresh))
+                rows.append((set_name, var_head, output, ps, res["f"][o], res["p"][o], sig))
+    return rows
+
+
+def write_cross_site_summary(rows, sites, path):
+    with open(path, 'w') as outfile:
+        outfile.write("\t".join(["set", "prefix", "output"] + ["p " + s for s in sites] +
+                                ["pooled f", "pooled p", "sites significant"]) + "\n")
+        for set_name, var_head, output, ps, f, p, sig in rows:
+            cells = ["" if np.isnan(x) else str(round(x, 4)) for x in ps]
+            outfile.write("\t".join([set_name, var_head, output] + cells +
+                                    [str(round(f, 2)), str(round(p, 4)), str(sig)]) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the analysis spec on every site export of a directory.")
+    parser.add_argument("data_dir")
+    parser.add_argument("--spec", default="npa_spec.json")
+    parser.add_argument("--out", default="results_sites")
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    sites = find_sites(args.data_dir)
+    if not sites:
+        raise FileNotFoundError("No npadata_*.csv exports in {0}".format(args.data_dir))
+
+    # A missing column fails inside a worker after other sites have written results, and a missing one-hot column
+    # reorders the categories of the merged cube, so mismatching exports stop the run before anything is read.
+    mismatches = check_schema(sites)
+    for site, (missing, extra) in mismatches.items():
+        print("{0}: missing {1}; extra {2}".format(site, missing, extra))
+    if mismatches:
+        raise ValueError("Exports of {0} do not have the columns of {1}".format(", ".join(mismatches),
+                                                                              next(iter(sites))))
+
+    spec = load_spec(args.spec)
+    analyses, _ = pooled_analyses(spec)
+    edges = pooled_bin_edges(sites) if spec.get("tumor_bins", True) else dict()
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(spec, edges)) as pool:
+        results = list(pool.map(_run_site, list(sites), list(sites.values()), [args.out] * len(sites)))
+    cubes = {site: cube for site, cube, _ in results}
+    # Every site bins tumor metrics with the pooled edges, so category labels agree across sites.
+    prefix_labels = results[0][2]
+
+    pooled = None
+    for site in sites:
+        pooled = cubes[site] if pooled is None else pooled + cubes[site]
+    pooled.save(os.path.join(args.out, "pooled.npz"))
+    for a in analyses:
+        for var_head in [v for v in a["prefixes"] if v in pooled.prefixes]:
+            pooled.write_anova_table(os.path.join(args.out, "pooled"), var_head, a["result_dir"], a["min_size"],
+                                     a["p_thresh"], prefix_labels.get(var_head))
+    write_cross_site_summary(cross_site_summary(cubes, pooled, analyses), list(sites),
+                             os.path.join(args.out, "cross_site_summary.tsv"))
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmarks for the NPA analysis scripts, run on a synthetic export with the same column layout as npadata_race.csv.
+
+    python npa_bench.py startup
+    python npa_bench.py backends --patients 5000 --data npadata_race.csv
+"""
+__author__ = "Arjit M; amisra2@illinois.edu"
+__version__ = "Feb 2 2024"
+
+import os
+import sys
+import time
+import argparse
+import contextlib
+import subprocess
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from npa_consts import P29_COMPONENTS, TUMOR_VARS, FUP_RES, PREFIX_TO_LABELS, PREFIX_IS_ONE_HOT, \
+    FUP_SYMPTOM_LABELS, BSL_SYMPTOM_LABELS, OUTPUT_SETS, OUTPUT_LIMITS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_synthetic_data(n_pt=1000, visits=2, seed=0):
+    """
+    Random visit-level export: one-hot and integer-coded prefixes, Promis-29 items with ~10% missing, raw and
+    T-scores, tumor size, symptom checkboxes and resolution flags.
+    """
+    rng = np.random.default_rng(seed)
+    n = n_pt * visits
+    cols = {"pt_study_id": np.repeat(np.arange(1, n_pt + 1), visits)}
+
+    def per_patient(a):
+        return np.repeat(a, visits)
+
+    for var_head, one_hot in PREFIX_IS_ONE_HOT.items():
+        labs = list(PREFIX_TO_LABELS.get(var_head).keys()) or list(range(1, 6))
+        if one_hot:
+            for lab in labs:
+                cols["{0}___{1}".format(var_head, lab)] = per_patient((rng.random(n_pt) < 0.2).astype(float))
+        else:
+            cols[var_head] = per_patient(rng.choice(labs, n_pt).astype(float))
+
+    for raw in P29_COMPONENTS.get("OUTPUTS")[:-1]:
+        items = P29_COMPONENTS.get(raw)
+        for it in items:
+            v = rng.integers(1, 6, n).astype(float)
+            v[rng.random(n) < 0.1] = np.nan
+            cols[it] = v
+        cols[raw] = np.sum([cols[it] for it in items], axis=0)
+        cols[raw.replace("_raw", "_t_score")] = 50 + (cols[raw] - 12) * 2.5
+    cols["p29_global07"] = rng.integers(0, 11, n).astype(float)
+    cols["age"] = per_patient(rng.integers(18, 85, n_pt).astype(float))
+
+    for c in TUMOR_VARS:
+        if c not in cols:
+            cols[c] = per_patient(rng.integers(1, 3, n_pt).astype(float))
+    for d in ["tsize_diam1", "tsize_diam2", "tsize_diam3"]:
+        cols[d] = per_patient(np.round(rng.gamma(2, 1.5, n_pt), 1))
+
+    for s in FUP_SYMPTOM_LABELS:
+        cols["fup_symptoms___{0}".format(s)] = (rng.random(n) < 0.08).astype(int)
+    for s in BSL_SYMPTOM_LABELS:
+        cols["bsl_symptoms___{0}".format(s)] = (rng.random(n) < 0.12).astype(int)
+    for c in FUP_RES:
+        cols[c] = rng.integers(0, 2, n).astype(float)
+
+    return pd.DataFrame(cols)
+
+
+def _time_python(code, repeat, cwd):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        subprocess.run([sys.executable, "-W", "ignore", "-c", code], cwd=cwd, check=True,
+                       env=dict(os.environ, MPLBACKEND="Agg"))
+        times.append(time.perf_counter() - t)
+    return min(times), np.median(times)
+
+
+def bench_startup(repeat=5, n_pt=300):
+    """
+    Process startup cost of a stats-only run versus the previous eager imports of pyplot, seaborn and scipy.stats.
+    Each case runs in a fresh interpreter; the first run of each case is discarded to warm the OS file cache.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        make_synthetic_data(n_pt).to_csv(os.path.join(tmp, "npadata_race.csv"), index=False)
+        setup = "import sys; sys.path.insert(0, {0!r}); ".format(HERE)
+        run = "import npa_new; a = npa_new.build_adf(npa_new.load_data('npadata_race.csv')); " \
+              "npa_new.do_anova('pgender', ['p29_pf_raw'], [20], a, one_hot=False, plot_mode=False, " \
+              "result_dir='r'); "
+        cases = [
+            ("eager imports (before)", setup + "from matplotlib import pyplot; import seaborn; "
+                                                "from scipy import stats; import npa_new"),
+            ("stats-only import", setup + "import npa_new; assert 'matplotlib' not in sys.modules"),
+            ("eager imports + one do_anova", setup + "from matplotlib import pyplot; import seaborn; " + run),
+            ("stats-only + one do_anova", setup + run + "assert 'matplotlib' not in sys.modules"),
+        ]
+        rows = []
+        for name, code in cases:
+            _time_python(code, 1, tmp)
+            best, med = _time_python(code, repeat, tmp)
+            rows.append((name, best, med))
+
+    print("{0:<32}{1:>10}{2:>10}".format("startup", "min s", "median s"))
+    for name, best, med in rows:
+        print("{0:<32}{1:>10.3f}{2:>10.3f}".format(name, best, med))
+    return rows
+
+
+def _sweep(adf, prefix_labels, prefix_one_hot, backend, root):
+    """
+    Stats-only do_anova of every prefix and output set with one backend. Returns seconds, analyses and outputs run.
+    """
+    from npa_new import do_anova
+
+    units = outputs_run = 0
+    t = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for var in prefix_labels:
+            for result_dir, outputs in OUTPUT_SETS.items():
+                out_max, out_min = OUTPUT_LIMITS.get(result_dir)
+                cube = do_anova(var, outputs, out_max, adf, prefix_one_hot.get(var), out_min=out_min, plot_mode=False,
+                                result_dir=os.path.join(root, result_dir), labels=prefix_labels.get(var),
+                                backend=backend)
+                if cube is not None:
+                    units += 1
+                    outputs_run += len(outputs)
+    return time.perf_counter() - t, units, outputs_run
+
+
+def bench_backends(repeat=3, n_pt=5000, data="npadata_race.csv"):
+    """
+    Throughput of the stats-only sweep with the reference and fast ANOVA backends, on a synthetic export of n_pt
+    patients and on the export at data if it exists.
+    """
+    from npa_new import load_data, prepare_adf
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        synthetic = os.path.join(tmp, "synthetic.csv")
+        make_synthetic_data(n_pt).to_csv(synthetic, index=False)
+        exports = [("synthetic", synthetic)] + ([("real", data)] if data and os.path.exists(data) else [])
+
+        for name, path in exports:
+            adf, prefix_labels, prefix_one_hot, _ = prepare_adf(load_data(path))
+            base = None
+            for backend in ["reference", "fast"]:
+                runs = [_sweep(adf, prefix_labels, prefix_one_hot, backend, os.path.join(tmp, backend))
+                        for _ in range(repeat)]
+                best, units, outputs_run = min(runs)
+                base = base or best
+                rows.append((name, len(adf), backend, units, best, units / best, outputs_run / best, base / best))
+
+    print("{0:<12}{1:>10}{2:>12}{3:>10}{4:>10}{5:>12}{6:>12}{7:>10}".format(
+        "data", "patients", "backend", "analyses", "min s", "analyses/s", "outputs/s", "speedup"))
+    for row in rows:
+        print("{0:<12}{1:>10}{2:>12}{3:>10}{4:>10.3f}{5:>12.1f}{6:>12.1f}{7:>10.2f}".format(*row))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("bench", choices=["startup", "backends"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--patients", type=int, default=5000, help="Patients of the synthetic export (backends).")
+    parser.add_argument("--data", default="npadata_race.csv", help="Real export to benchmark as well (backends).")
+    args = parser.parse_args()
+
+    if args.bench == "startup":
+        bench_startup(args.repeat)
+    elif args.bench == "backends":
+        bench_backends(args.repeat, args.patients, args.data)
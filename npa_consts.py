@@ -67,6 +67,48 @@ FUP_LOC = [
     'fup_fn_loc',
 ]
 
+"""
+Resolution column of FUP_RES for each symptom code of FUP_SYMPTOM_LABELS / BSL_SYMPTOM_LABELS. Left/right/bilateral
+variants (e.g. fup_vail_res) and deficits without a symptom code (fup_fnd_res) are not mapped.
+"""
+SYMPTOM_RES = {
+    0: 'fup_new_memory_res',
+    1: 'fup_headache_res',
+    2: 'fup_hydro_res',
+    3: 'fup_nausea_res',
+    4: 'fup_seizure_res',
+    10: 'fup_dv_res',
+    15: 'fup_hearimp_res',
+    16: 'fup_dysphagia_res',
+    17: 'fup_vcd_res',
+    18: 'fup_tongue_res',
+    23: 'fup_wtm_res',
+    25: 'fup_fsd_res',
+    26: 'fup_gait_res',
+    27: 'fup_other_res',
+    30: 'fup_dysphasia',
+    31: 'fup_galactorrhea',
+    32: 'fup_amenorrhea',
+    33: 'fup_vertigo',
+    34: 'fup_exper_aph',
+    35: 'fup_rec_aph',
+    37: 'fup_ams',
+    38: 'fup_vai_res',
+    39: 'fup_vfl_res',
+    40: 'fup_fn_res',
+    41: 'fup_fw_res',
+    42: 'fup_wue_res',
+    43: 'fup_wle_res',
+}
+
+"""
+Codes of FUP_SYMPTOM_LABELS / BSL_SYMPTOM_LABELS that are screening outcomes rather than symptoms: 28 (No symptoms
+found on screening) and 99 (Unknown). They count towards fup_total / bsl_total, but not as symptoms in change,
+co-occurrence or resolution tables. A side with only UNKNOWN_CODES checked is not recorded.
+"""
+EXCLUDE_CODES = [28, 99]
+UNKNOWN_CODES = [99]
+
 """
 List of column names concerning tumor physical characteristics, size, etc.
 """
@@ -120,6 +162,16 @@ TUMOR_VARS = [
     'two_staged',
 ]
 
+"""
+Continuous tumor metrics derived from TUMOR_VARS (see npa_helpers.generateTumorDf) and the number of quantile
+categories each is binned into for the ANOVA sweep, as prefix <metric>_q.
+"""
+TUMOR_METRICS = [
+    'tvol',
+    'dmax',
+]
+TUMOR_METRIC_QUANTILES = 4
+
 
 # Aggregate variables
 
@@ -561,6 +613,36 @@ PREFIX_IS_ONE_HOT = {
 }
 
 
+"""
+Output sets of the ANOVA sweep, keyed by the result directory each is written to.
+"""
+OUTPUT_SETS = {
+    "results_raw_outputs": P29_COMPONENTS["OUTPUTS"],
+    "results_t_outputs": P29_COMPONENTS["OUTPUTS_t"],
+    "results_summary": ["p29_Mental_Health_Summ", "p29_Physical_Health_Summ"],
+    "results_symptoms": ["fup_total", "bsl_total", "symptom_diff"],
+}
+
+"""
+Plot axis limits (out_max, out_min) of each output set; out_min None is 0 for every output.
+"""
+OUTPUT_LIMITS = {
+    "results_raw_outputs": (P29_COMPONENTS["OUTPUT_MAX"], None),
+    "results_t_outputs": ([100] * len(P29_COMPONENTS["OUTPUTS_t"]), None),
+    "results_summary": ([100, 100], None),
+    "results_symptoms": ([10, 10, 5], [0, 0, -5]),
+}
+
+"""
+Covariates of the ANCOVA mode (npa_ancova). Columns that are prefixes of PREFIX_TO_LABELS are treated as categorical.
+"""
+ANCOVA_COVARIATES = [
+    'age',
+    'pgender',
+    'insurance1',
+]
+
+
 PHYS_HLTH_SUMMARY = [
     0.872,
     -0.094,
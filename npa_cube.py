@@ -0,0 +1,314 @@
+"""
+Per-group sufficient statistics. A GroupCube holds count, sum and sum of squares of every output within every category
+of one prefix, from which one-way ANOVA, Tukey HSD, group means/variances and effect sizes follow without touching the
+patient frame again.
+
+A StatsCube holds the same statistics, plus min and max, for every prefix of PREFIX_IS_ONE_HOT and every output of
+OUTPUT_SETS. Cubes built on separate site exports or shards of patients merge exactly (counts and sums add, min/max
+reduce), so sites can exchange cubes instead of patient data and still reproduce the do_anova tables of the pooled
+data:
+
+    python npa_cube.py build site_a.csv -o site_a.npz
+    python npa_cube.py merge site_a.npz site_b.npz -o pooled.npz
+    python npa_cube.py tables pooled.npz --out cube_results
+"""
+__author__ = "Arjit M; amisra2@illinois.edu"
+__version__ = "Feb 2 2024"
+
+import os
+import re
+import argparse
+
+import numpy as np
+
+from npa_consts import PREFIX_TO_LABELS, PREFIX_IS_ONE_HOT, OUTPUT_SETS
+
+
+class GroupCube:
+    """
+    Arrays n, s, ss of shape (categories, outputs): non-nan count, sum and sum of squares.
+    """
+
+    def __init__(self, outputs, n, s, ss):
+        self.outputs = list(outputs)
+        self.n = n
+        self.s = s
+        self.ss = ss
+
+    @classmethod
+    def from_masks(cls, values, masks, outputs):
+        """
+        values: (patients, outputs) float with nan for missing; masks: (patients, categories) bool.
+        """
+        ok = ~np.isnan(values)
+        v = np.where(ok, values, 0)
+        m = masks.astype(float)
+        return cls(outputs, m.T @ ok, m.T @ v, m.T @ v ** 2)
+
+    @property
+    def mean(self):
+        return self.s / self.n
+
+    @property
+    def ssd(self):
+        """
+        Within-group sum of squared deviations.
+        """
+        return self.ss - self.s ** 2 / self.n
+
+    @property
+    def var(self):
+        return self.ssd / (self.n - 1)
+
+    def anova(self):
+        """
+        One-way ANOVA of every output. Returns dict of (outputs,) arrays f, p, ssb, ssw, df1, df2.
+        """
+        from scipy import stats
+
+        N = self.n.sum(axis=0)
+        k = len(self.n)
+        grand = self.s.sum(axis=0) / N
+        ssb = np.sum(self.n * (self.mean - grand) ** 2, axis=0)
+        ssw = np.sum(self.ssd, axis=0)
+        df1, df2 = k - 1, N - k
+        with np.errstate(divide="ignore", invalid="ignore"):
+            f = (ssb / df1) / (ssw / df2)
+        return dict(f=f, p=stats.f.sf(f, df1, df2), ssb=ssb, ssw=ssw, df1=np.full(len(N), df1), df2=df2)
+
+    def tukey(self, o):
+        """
+        Tukey-Kramer HSD of output index o, as scipy.stats.tukey_hsd: p-values and mean differences (row - column).
+        """
+        from scipy import stats
+
+        n, mean = self.n[:, o], self.mean[:, o]
+        k, N = len(n), n.sum()
+        mse = np.sum(self.ssd[:, o]) / (N - k)
+        T = mean[:, None] - mean[None, :]
+        i, j = np.triu_indices(k, 1)
+        se = np.sqrt(mse / 2 * (1 / n[i] + 1 / n[j]))
+        Pij = np.ones((k, k))
+        Pij[i, j] = Pij[j, i] = np.clip(stats.studentized_range.sf(np.abs(T[i, j]) / se, k, N - k), 0, 1)
+        return Pij, T
+
+
+class StatsCube:
+    """
+    (prefix, category, output) -> count, sum, sum of squares, min, max.
+
+    prefixes maps each prefix to a dict of arrays: keys (category label numbers, in do_anova order), n, s, ss, mn, mx
+    of shape (categories, outputs) and complete of shape (categories, output sets), the number of patients of the
+    category with every output of the set present, which decides min_size exactly as do_anova does.
+    """
+
+    FIELDS = ["n", "s", "ss", "mn", "mx", "complete"]
+
+    def __init__(self, outputs, output_sets, prefixes):
+        self.outputs = list(outputs)
+        self.output_sets = {k: list(v) for k, v in output_sets.items()}
+        self.prefixes = prefixes
+
+    @classmethod
+    def build(cls, data, output_sets=OUTPUT_SETS, prefix_one_hot=PREFIX_IS_ONE_HOT):
+        from npa_new import category_label_num
+
+        outputs = list(dict.fromkeys(o for outs in output_sets.values() for o in outs))
+        V = data[outputs].to_numpy(dtype=float)
+        ok = ~np.isnan(V)
+        v = np.where(ok, V, 0)
+        complete = np.column_stack([ok[:, [outputs.index(o) for o in outs]].all(axis=1)
+                                    for outs in output_sets.values()])
+
+        prefixes = dict()
+        for var_head, one_hot in prefix_one_hot.items():
+            if one_hot:
+                cols = [c for c in data.columns if re.match("{0}_*\\d+".format(var_head), c)]
+                keys = [category_label_num(var_head, c, True) for c in cols]
+                masks = [(data[c] == 1).to_numpy() for c in cols]
+            elif var_head in data.columns:
+                col = data[var_head].to_numpy(dtype=float)
+                keys = np.unique(col[~np.isnan(col)])
+                masks = [col == C for C in keys]
+            else:
+                continue
+
+            M = np.column_stack(masks).astype(float) if masks else np.zeros((len(data), 0))
+            # initial= keeps min/max defined on shards without patients.
+            mn = np.array([np.where(ok & m[:, None], V, np.inf).min(axis=0, initial=np.inf) for m in M.T.astype(bool)])
+            mx = np.array([np.where(ok & m[:, None], V, -np.inf).max(axis=0, initial=-np.inf)
+                           for m in M.T.astype(bool)])
+            prefixes[var_head] = dict(
+                keys=np.asarray(keys, dtype=float), n=M.T @ ok, s=M.T @ v, ss=M.T @ v ** 2,
+                mn=mn.reshape(len(keys), len(outputs)), mx=mx.reshape(len(keys), len(outputs)),
+                complete=M.T @ complete,
+            )
+        return cls(outputs, output_sets, prefixes)
+
+    def merge(self, other):
+        """
+        Cube of the union of both shards' patients. Categories missing from one shard count as empty.
+        """
+        if self.outputs != other.outputs or self.output_sets != other.output_sets:
+            raise ValueError("Cubes were built for different outputs and cannot be merged.")
+
+        prefixes = dict()
+        for var_head in list(self.prefixes) + [v for v in other.prefixes if v not in self.prefixes]:
+            a = self.prefixes.get(var_head)
+            b = other.prefixes.get(var_head)
+            if a is None or b is None:
+                prefixes[var_head] = dict(a or b)
+                continue
+
+            keys = list(a["keys"]) + [k for k in b["keys"] if k not in a["keys"]]
+            if not PREFIX_IS_ONE_HOT.get(var_head, False):
+                keys = sorted(keys)
+            merged = dict(keys=np.array(keys))
+            ia = [keys.index(k) for k in a["keys"]]
+            ib = [keys.index(k) for k in b["keys"]]
+            for field in self.FIELDS:
+                fill = {"mn": np.inf, "mx": -np.inf}.get(field, 0)
+                arr = np.full((len(keys),) + a[field].shape[1:], fill, dtype=float)
+                arr[ia] = a[field]
+                if field == "mn":
+                    arr[ib] = np.minimum(arr[ib], b[field])
+                elif field == "mx":
+                    arr[ib] = np.maximum(arr[ib], b[field])
+                else:
+                    arr[ib] += b[field]
+                merged[field] = arr
+            prefixes[var_head] = merged
+        return StatsCube(self.outputs, self.output_sets, prefixes)
+
+    def __add__(self, other):
+        return self.merge(other)
+
+    def __neg__(self):
+        """
+        Cube that removes these patients when merged: counts and sums negated. Min/max cannot be removed and are left
+        to the other operand, which is exact for append-only updates, where values are only ever filled in.
+        """
+        prefixes = dict()
+        for var_head, p in self.prefixes.items():
+            neg = {field: -p[field] for field in ["n", "s", "ss", "complete"]}
+            neg.update(keys=p["keys"], mn=np.full(p["mn"].shape, np.inf), mx=np.full(p["mx"].shape, -np.inf))
+            prefixes[var_head] = neg
+        return StatsCube(self.outputs, self.output_sets, prefixes)
+
+    def __sub__(self, other):
+        return self.merge(-other)
+
+    def save(self, path):
+        arrays = {"outputs": np.array(self.outputs), "set_names": np.array(list(self.output_sets))}
+        for name, outs in self.output_sets.items():
+            arrays["set/" + name] = np.array(outs)
+        for var_head, fields in self.prefixes.items():
+            for field, arr in fields.items():
+                arrays["{0}/{1}".format(var_head, field)] = arr
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as z:
+            outputs = list(z["outputs"])
+            output_sets = {name: list(z["set/" + name]) for name in z["set_names"]}
+            prefixes = dict()
+            for name in z.files:
+                var_head, _, field = name.rpartition("/")
+                if var_head and var_head != "set":
+                    prefixes.setdefault(var_head, dict())[field] = z[name]
+        return cls(outputs, output_sets, prefixes)
+
+    def categories(self, var_head, set_name, min_size=15):
+        """
+        Indices of the categories of var_head that do_anova would keep for an output set.
+        """
+        complete = self.prefixes[var_head]["complete"][:, list(self.output_sets).index(set_name)]
+        return np.where(complete > min_size)[0]
+
+    def group_cube(self, var_head, set_name, min_size=15):
+        """
+        GroupCube of the categories and outputs do_anova would analyse.
+        """
+        p = self.prefixes[var_head]
+        cats = self.categories(var_head, set_name, min_size)
+        cols = [self.outputs.index(o) for o in self.output_sets[set_name]]
+        cube = GroupCube(self.output_sets[set_name], *[p[f][np.ix_(cats, cols)] for f in ["n", "s", "ss"]])
+        return p["keys"][cats], cube
+
+    def anova_table(self, var_head, set_name, min_size=15, p_thresh=0.05, labels=None):
+        """
+        Rows of the do_anova TSV for one prefix and output set, or None if fewer than two categories qualify. labels:
+        category labels of the prefix (e.g. from prepare_adf), defaulting to PREFIX_TO_LABELS.
+        """
+        from npa_helpers import getGroupLabels
+
+        keys, cube = self.group_cube(var_head, set_name, min_size)
+        if len(keys) < 2:
+            return None
+
+        labeller = labels if labels is not None else PREFIX_TO_LABELS.get(var_head, dict())
+        cat_labs = [str(labeller.get(int(k), int(k))) for k in keys]
+        rows = ["\t".join([''] + cat_labs + ["ANOVA"])]
+        a = cube.anova()
+        for o, output in enumerate(cube.outputs):
+            p, f = a["p"][o], a["f"][o]
+            diff_str = ['a' for _ in keys]
+            if p < p_thresh:
+                Pij, _ = cube.tukey(o)
+                diff_str = getGroupLabels(Pij < p_thresh)
+            row = [output] + ["{0} ({1}) N={2}".format(round(m, 2), d, int(n))
+                              for m, d, n in zip(cube.mean[:, o], diff_str, cube.n[:, o])]
+            row.append("p={0} f={1}".format(round(p, 4), round(f, 2)) if p < p_thresh else "p>{0}".format(p_thresh))
+            rows.append("\t".join(row))
+        return rows
+
+    def write_anova_table(self, out_root, var_head, set_name, min_size=15, p_thresh=0.05, labels=None):
+        """
+        <out_root>/<output set>/<prefix>_anova_tHSD.tsv, as written by do_anova, if at least two categories qualify.
+        """
+        rows = self.anova_table(var_head, set_name, min_size, p_thresh, labels)
+        if rows is None:
+            return
+        os.makedirs("{0}/{1}".format(out_root, set_name), exist_ok=True)
+        with open("{0}/{1}/{2}_anova_tHSD.tsv".format(out_root, set_name, var_head), 'w') as outfile:
+            for ln in rows:
+                outfile.write(ln + "\n")
+
+    def write_anova_tables(self, out_root="cube_results", min_size=15, p_thresh=0.05, prefix_labels=None):
+        """
+        do_anova TSVs of every output set and prefix. prefix_labels: {prefix: category labels}, as from prepare_adf.
+        """
+        prefix_labels = prefix_labels or dict()
+        for set_name in self.output_sets:
+            for var_head in self.prefixes:
+                self.write_anova_table(out_root, var_head, set_name, min_size, p_thresh, prefix_labels.get(var_head))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build, merge and tabulate mergeable group-statistics cubes.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_build = sub.add_parser("build", help="Cube of one site export")
+    p_build.add_argument("data")
+    p_build.add_argument("-o", "--out", required=True)
+    p_merge = sub.add_parser("merge", help="Merge cubes of several sites or shards")
+    p_merge.add_argument("cubes", nargs="+")
+    p_merge.add_argument("-o", "--out", required=True)
+    p_tables = sub.add_parser("tables", help="ANOVA tables of a cube")
+    p_tables.add_argument("cube")
+    p_tables.add_argument("--out", default="cube_results")
+    p_tables.add_argument("--min-size", type=int, default=15)
+    p_tables.add_argument("--p-thresh", type=float, default=0.05)
+    args = parser.parse_args()
+
+    if args.cmd == "build":
+        from npa_new import load_data, build_adf
+
+        StatsCube.build(build_adf(load_data(args.data))).save(args.out)
+    elif args.cmd == "merge":
+        cube = StatsCube.load(args.cubes[0])
+        for path in args.cubes[1:]:
+            cube = cube + StatsCube.load(path)
+        cube.save(args.out)
+    else:
+        StatsCube.load(args.cube).write_anova_tables(args.out, args.min_size, args.p_thresh)
@@ -0,0 +1,219 @@
+"""
+Effect sizes and power of the one-way ANOVAs, computed from the GroupCube of each prefix (the same counts, sums and
+sums of squares the ANOVA uses).
+
+    eta^2   = SSB / SST, with a noncentral-F confidence interval
+    omega^2 = (SSB - df1 * MSW) / (SST + MSW)
+    f       = sqrt(eta^2 / (1 - eta^2))   (Cohen)
+    g_ij    = J * (mean_i - mean_j) / s_pooled,ij   (Hedges, with normal-approximation CI)
+
+Power is estimated by Monte Carlo at the observed group sizes, means and pooled within-group SD. Under normal errors
+the group means and the within-group sum of squares are independent normal and scaled chi-square draws, so each
+simulated ANOVA costs O(categories) instead of O(patients) and many thousands are drawn in one batch.
+"""
+__author__ = "Arjit M; amisra2@illinois.edu"
+__version__ = "Feb 2 2024"
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def _ncf_lambda(F, df1, df2, target, iters=50):
+    """
+    Noncentrality at which the noncentral F cdf at F equals target (0 if already below target at zero). Vectorised
+    bisection over all outputs at once; the cdf decreases in the noncentrality.
+    """
+    from scipy.special import fdtr, ncfdtr
+
+    F, df1, df2 = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (F, df1, df2)])
+    need = np.isfinite(F) & (fdtr(df1, df2, F) > target)
+
+    lo = np.zeros(F.shape)
+    hi = np.where(need, np.maximum(1.0, F * df1), 0)
+    grow = need.copy()
+    while grow.any():
+        hi = np.where(grow, hi * 2, hi)
+        grow = need & (ncfdtr(df1, df2, hi, F) > target)
+
+    for _ in range(iters):
+        mid = (lo + hi) / 2
+        above = ncfdtr(df1, df2, mid, F) > target
+        lo = np.where(above, mid, lo)
+        hi = np.where(above, hi, mid)
+    return np.where(need, (lo + hi) / 2, 0)
+
+
+def eta2_ci(F, df1, df2, conf=0.95):
+    """
+    Confidence interval of eta^2 by inverting the noncentral F distribution.
+    """
+    N = np.asarray(df1) + np.asarray(df2) + 1
+    alpha = 1 - conf
+    lo = _ncf_lambda(F, df1, df2, 1 - alpha / 2)
+    hi = _ncf_lambda(F, df1, df2, alpha / 2)
+    nan = ~np.isfinite(F)
+    return np.where(nan, np.nan, lo / (lo + N)), np.where(nan, np.nan, hi / (hi + N))
+
+
+def effect_sizes(cube, conf=0.95):
+    """
+    Omnibus effect sizes of every output of a GroupCube. Returns dict of (outputs,) arrays.
+    """
+    a = cube.anova()
+    sst = a["ssb"] + a["ssw"]
+    msw = a["ssw"] / a["df2"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        eta2 = a["ssb"] / sst
+        omega2 = (a["ssb"] - a["df1"] * msw) / (sst + msw)
+        cohen_f = np.sqrt(eta2 / (1 - eta2))
+    lo, hi = eta2_ci(a["f"], a["df1"], a["df2"], conf)
+    return dict(eta2=eta2, eta2_lo=lo, eta2_hi=hi, omega2=omega2, cohen_f=cohen_f, f=a["f"], p=a["p"])
+
+
+def hedges_g(cube, conf=0.95):
+    """
+    Pairwise Hedges' g (row category minus column category) with CIs. Returns arrays of shape
+    (outputs, categories, categories).
+    """
+    from scipy import stats
+
+    n = cube.n.T[:, :, None]
+    n2 = cube.n.T[:, None, :]
+    d = cube.mean.T[:, :, None] - cube.mean.T[:, None, :]
+    ssd = cube.ssd.T[:, :, None] + cube.ssd.T[:, None, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sp = np.sqrt(ssd / (n + n2 - 2))
+        J = 1 - 3 / (4 * (n + n2) - 9)
+        g = J * d / sp
+        se = np.sqrt((n + n2) / (n * n2) + g ** 2 / (2 * (n + n2)))
+    z = stats.norm.ppf(0.5 + conf / 2)
+    return g, g - z * se, g + z * se
+
+
+def write_effect_sizes(path, cube, cat_labs, conf=0.95):
+    """
+    TSV of omnibus effect sizes per output followed by pairwise Hedges' g per output.
+    """
+    es = effect_sizes(cube, conf)
+    g, lo, hi = hedges_g(cube, conf)
+    k = len(cat_labs)
+    pct = int(round(conf * 100))
+
+    with open(path, 'w') as outfile:
+        outfile.write("\t".join(["", "eta2", "eta2 {0}% CI".format(pct), "omega2", "cohen_f"]) + "\n")
+        for o, output in enumerate(cube.outputs):
+            outfile.write("{0}\t{1}\t[{2}, {3}]\t{4}\t{5}\n".format(
+                output, round(es["eta2"][o], 4), round(es["eta2_lo"][o], 4), round(es["eta2_hi"][o], 4),
+                round(es["omega2"][o], 4), round(es["cohen_f"][o], 4)))
+
+        outfile.write("\n")
+        outfile.write("\t".join(["", "Group i", "Group j", "hedges_g", "g {0}% CI".format(pct)]) + "\n")
+        for o, output in enumerate(cube.outputs):
+            for i in range(k):
+                for j in range(i + 1, k):
+                    outfile.write("{0}\t{1}\t{2}\t{3}\t[{4}, {5}]\n".format(
+                        output, cat_labs[i], cat_labs[j], round(g[o, i, j], 3), round(lo[o, i, j], 3),
+                        round(hi[o, i, j], 3)))
+    return es
+
+
+def simulate_power(n, means, sd, alpha=0.05, sims=10000, rng=None, batch=100000):
+    """
+    Monte Carlo power of the one-way ANOVA F test for group sizes n, true group means and common SD.
+    """
+    from scipy import stats
+
+    rng = np.random.default_rng(rng)
+    n = np.asarray(n, dtype=float)
+    means = np.asarray(means, dtype=float)
+    k = len(n)
+    N = n.sum()
+    crit = stats.f.isf(alpha, k - 1, N - k)
+
+    hits = 0
+    done = 0
+    while done < sims:
+        b = min(batch, sims - done)
+        m = means + sd / np.sqrt(n) * rng.standard_normal((b, k))
+        ssw = sd ** 2 * rng.chisquare(N - k, b)
+        grand = m @ n / N
+        ssb = ((m - grand[:, None]) ** 2) @ n
+        hits += np.count_nonzero((ssb / (k - 1)) / (ssw / (N - k)) > crit)
+        done += b
+    return hits / sims
+
+
+def analytic_power(n, means, sd, alpha=0.05):
+    """
+    Power of the F test from the noncentral F distribution, as a check on simulate_power.
+    """
+    from scipy import stats
+
+    n = np.asarray(n, dtype=float)
+    means = np.asarray(means, dtype=float)
+    k, N = len(n), n.sum()
+    lam = np.sum(n * (means - means @ n / N) ** 2) / sd ** 2
+    return stats.ncf.sf(stats.f.isf(alpha, k - 1, N - k), k - 1, N - k, lam)
+
+
+def cube_power_designs(cube):
+    """
+    (n, means, sd) of every output of a GroupCube, taking the observed means as the true effect.
+    """
+    a = cube.anova()
+    sd = np.sqrt(a["ssw"] / a["df2"])
+    return [(cube.n[:, o], cube.mean[:, o], sd[o]) for o in range(len(cube.outputs))]
+
+
+def _power_chunk(designs, alpha, sims, seed):
+    rng = np.random.default_rng(seed)
+    return [simulate_power(n, means, sd, alpha, sims, rng) for n, means, sd in designs]
+
+
+def sweep_power(designs, alpha=0.05, sims=10000, workers=None, chunk=64, seed=0):
+    """
+    Monte Carlo power of many (n, means, sd) designs, in chunks spread over worker processes.
+    """
+    chunks = [designs[i:i + chunk] for i in range(0, len(designs), chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        res = pool.map(_power_chunk, chunks, [alpha] * len(chunks), [sims] * len(chunks), seeds)
+    return [p for r in res for p in r]
+
+
+def sweep_cube_power(cubes, alpha=0.05, sims=10000, workers=None, seed=0):
+    """
+    Power of every output of every cube. cubes: {(result_dir, var_head): GroupCube}. Returns rows of
+    (result_dir, var_head, output, categories, N, cohen_f, simulated power, analytic power).
+    """
+    keys, designs = [], []
+    for (result_dir, var_head), cube in cubes.items():
+        for output, design in zip(cube.outputs, cube_power_designs(cube)):
+            keys.append((result_dir, var_head, output))
+            designs.append(design)
+
+    simulated = sweep_power(designs, alpha, sims, workers, seed=seed)
+    rows = []
+    for (result_dir, var_head, output), (n, means, sd), p_sim in zip(keys, designs, simulated):
+        lam_f = np.sqrt(np.sum(n * (means - means @ n / n.sum()) ** 2) / n.sum()) / sd
+        rows.append((result_dir, var_head, output, len(n), int(n.sum()), lam_f, p_sim,
+                     analytic_power(n, means, sd, alpha)))
+    return rows
+
+
+def write_power_tables(rows, sims, alpha=0.05):
+    """
+    One power.tsv per result directory.
+    """
+    by_dir = dict()
+    for row in rows:
+        by_dir.setdefault(row[0], []).append(row[1:])
+
+    for result_dir, dir_rows in by_dir.items():
+        with open("{0}/power.tsv".format(result_dir), 'w') as outfile:
+            outfile.write("\t".join(["prefix", "output", "categories", "N", "cohen_f",
+                                     "power (MC, {0} sims, alpha={1})".format(sims, alpha), "power (ncF)"]) + "\n")
+            for var_head, output, k, N, f, p_sim, p_an in dir_rows:
+                outfile.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n".format(
+                    var_head, output, k, N, round(f, 4), round(p_sim, 4), round(p_an, 4)))
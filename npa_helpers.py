@@ -1,15 +1,20 @@
 import numpy as np
 import pandas as pd
-from npa_consts import TUMOR_VARS
-import seaborn as sns
-import matplotlib as mpl
-from matplotlib import pyplot as plt
+from npa_consts import TUMOR_VARS, TUMOR_METRICS, TUMOR_METRIC_QUANTILES
+from functools import lru_cache
 from textwrap import wrap
 
-cseq = mpl.color_sequences.get('tab20b')[0::5] + mpl.color_sequences.get('tab20c')[0::5] + \
-       mpl.color_sequences.get('tab20b')[2::5] + mpl.color_sequences.get('tab20c')[2::5] + \
-       mpl.color_sequences.get('tab20b')[1::5] + mpl.color_sequences.get('tab20c')[1::5] + \
-       mpl.color_sequences.get('tab20b')[3::5] + mpl.color_sequences.get('tab20c')[3::5]
+# matplotlib and seaborn are imported on first use only, so that stats-only runs never pay for them.
+
+
+@lru_cache(maxsize=None)
+def color_sequence():
+    import matplotlib as mpl
+
+    return mpl.color_sequences.get('tab20b')[0::5] + mpl.color_sequences.get('tab20c')[0::5] + \
+        mpl.color_sequences.get('tab20b')[2::5] + mpl.color_sequences.get('tab20c')[2::5] + \
+        mpl.color_sequences.get('tab20b')[1::5] + mpl.color_sequences.get('tab20c')[1::5] + \
+        mpl.color_sequences.get('tab20b')[3::5] + mpl.color_sequences.get('tab20c')[3::5]
 
 def getGroupLabels(G):
     eq_groups = set()
@@ -69,37 +74,70 @@ def getGroupLabels(G):
     return diff_str
 
 
-def generateTumorDf(df):
-
+def generateTumorDf(df, path="npa_tumor_data.csv"):
+    """
+    Per-patient tumor variables with derived volume (tvol, mm^3) and maximum diameter (dmax, mm), indexed by
+    pt_study_id. Written to path unless path is None.
+    """
     tdf = df[TUMOR_VARS + ["pt_study_id"]].groupby("pt_study_id").first()
-    tsize = tdf[["tsize_diam1","tsize_diam2", "tsize_diam3"]].convert_dtypes(convert_string=True)
-    tunit = tdf[["tsize_axial_unit_2", "tsize_axial_unit_4", "tsize_axial_unit_3"]]
-    tunit.dropna(how="all")
-    tsize.dropna(how='all')
 
-    tvol = []  # 3D tumor volume calculated as d1.d2.d3
-    dmax = []  # maximum diameter along any axis
+    # Non-numeric diameters are treated as missing.
+    tsize = tdf[["tsize_diam1", "tsize_diam2", "tsize_diam3"]].apply(pd.to_numeric, errors="coerce").to_numpy()
+    tunit = tdf[["tsize_axial_unit_2", "tsize_axial_unit_4", "tsize_axial_unit_3"]].to_numpy()
+
+    # convert to mm, assume default is mm for nan values. key: 1 = cm; 2 = mm
+    tsize_mm = np.where(tunit == 1, tsize * 10, tsize)
+
+    tdf["tvol"] = np.prod(tsize_mm, axis=1)  # 3D tumor volume calculated as d1.d2.d3
+    tdf["dmax"] = np.max(tsize_mm, axis=1)  # maximum diameter along any axis
+
+    if path is not None:
+        tdf.to_csv(path)
+    return tdf
 
-    for row in tdf.itertuples(index=False):
-        try:
-            frow = [float(d) for d in [row.tsize_diam1, row.tsize_diam2, row.tsize_diam3]]
-            # convert to mm, assume default is mm for nan values. key: 1 = cm; 2 = mm
-            units_pow = np.sum([u==1 for u in [row.tsize_axial_unit_2, row.tsize_axial_unit_4, row.tsize_axial_unit_3]])
-            tvol.append(np.prod(frow) * 10**units_pow)
-            dmax.append(np.max(frow))
-        except:
-            tvol.append(np.nan)
-            dmax.append(np.nan)
+
+def join_tumor_metrics(adf, df, metrics=TUMOR_METRICS):
+    """
+    Add tumor metrics to the per-patient frame, joined in memory on the pt_study_id index.
+    """
+    tdf = generateTumorDf(df, path=None)
+    return adf.drop(columns=list(metrics), errors="ignore").join(tdf[list(metrics)])
 
 
-    tdf["tvol"] = tvol
-    tdf["dmax"] = dmax
+def quantile_bin_edges(values, q=TUMOR_METRIC_QUANTILES):
+    return np.nanquantile(np.asarray(values, dtype=float), np.linspace(0, 1, q + 1))
 
-    tdf.to_csv("npa_tumor_data.csv")
+
+def bin_tumor_metrics(adf, edges=None, metrics=TUMOR_METRICS, q=TUMOR_METRIC_QUANTILES):
+    """
+    Bin each continuous metric into quantile categories 1..q as column <metric>_q. edges: {metric: bin edges} to
+    reuse, e.g. those of an earlier run or of pooled sites, so that categories mean the same across frames; edges of
+    other metrics are the quantiles of adf. Returns labels for the new prefixes in the layout of PREFIX_TO_LABELS
+    and the edges used.
+    """
+    labels = dict()
+    edges = dict(edges or dict())
+    for metric in metrics:
+        values = adf[metric].to_numpy(dtype=float)
+        if metric not in edges:
+            edges[metric] = quantile_bin_edges(values, q)
+        e = edges[metric]
+        bins = np.searchsorted(e[1:-1], values, side="right") + 1.0
+        bins[np.isnan(values)] = np.nan
+        adf[metric + "_q"] = bins
+        labels[metric + "_q"] = {k + 1: "Q{0} {1} [{2:.4g}, {3:.4g}{4}".format(k + 1, metric, e[k], e[k + 1],
+                                                                         "]" if k == len(e) - 2 else ")")
+                                 for k in range(len(e) - 1)}
+    return labels, edges
 
 
 def make_ind_plots(num_out, ax, out_i, out_max, out_min, output, to, catnum_to_labnum, labnum_to_catnum, labeller,
-                   result_dir, var_head, diff_str):
+                   result_dir, var_head, diff_str, report=None, order=None):
+    import seaborn as sns
+    from matplotlib import pyplot as plt
+
+    cseq = color_sequence()
+
     if num_out > 2:
         ax_plt = ax[out_i // 2][out_i % 2]
     elif num_out == 2:
@@ -142,10 +180,10 @@ def make_ind_plots(num_out, ax, out_i, out_max, out_min, output, to, catnum_to_l
     # 0: Category_i values; 1: Category_i+1 values; ...
     data = {k: v for k, v in enumerate(to)}
 
-    # A: 5, B: 3, C: 6, ... such that mean(A) > mean(B) > ...
-    size_map = {chr(ord('A')+k): catnum_to_labnum.get(v) for k, v in enumerate(
-        sorted(data.keys(), key=lambda m: np.mean(data.get(m)), reverse=True)
-    )}
+    # A: 5, B: 3, C: 6, ... such that mean(A) > mean(B) > ...; order is the GroupSummary rank order when given.
+    if order is None:
+        order = sorted(data.keys(), key=lambda m: np.mean(data.get(m)), reverse=True)
+    size_map = {chr(ord('A')+k): catnum_to_labnum.get(v) for k, v in enumerate(order)}
 
     # A: Category_i+5 values, ...
     size_order_data = {k: data.get(labnum_to_catnum.get(size_map.get(k))) for k in size_map.keys()}
@@ -197,5 +235,9 @@ def make_ind_plots(num_out, ax, out_i, out_max, out_min, output, to, catnum_to_l
             ha='center', va='bottom',
         )
 
-    fig_ind.savefig("{0}/{1}/{2}.jpg".format(result_dir, var_head, output), dpi=600)
+    if report is not None:
+        report.add(fig_ind, "{0}/{1}".format(var_head, output))
+    else:
+        fig_ind.savefig("{0}/{1}/{2}.jpg".format(result_dir, var_head, output), dpi=600)
+        plt.close(fig_ind)
 
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Multiple imputation of missing Promis-29 items followed by one-way ANOVA / Tukey HSD on every imputed dataset, pooled
+with Rubin's rules.
+
+Imputation is by chained equations with predictive mean matching (PMM), so imputed items stay on the observed 1-5
+response scale and imputed T-scores are always values that occur in the data. Raw scores are imputed passively as the
+sum of their (imputed) items and all z-scores and health summaries are re-derived from the imputed T-scores exactly as
+in npa_new.
+
+Only the imputed cells are kept: an ImputedData holds one (patients x columns) matrix with nan holes and an
+(imputations x holes) array of fill values, rather than M copies of the patient frame.
+"""
+__author__ = "Arjit M; amisra2@illinois.edu"
+__version__ = "Feb 2 2024"
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from npa_consts import P29_COMPONENTS, PREFIX_TO_LABELS, PREFIX_IS_ONE_HOT
+from npa_helpers import getGroupLabels
+from npa_new import derive_p29_scores, find_categories, category_masks, category_label_num, load_data, build_adf
+
+# Raw scores that are sums of survey items, and the items themselves.
+P29_RAW = [o for o in P29_COMPONENTS.get("OUTPUTS") if o in P29_COMPONENTS]
+P29_ITEMS = [it for o in P29_RAW for it in P29_COMPONENTS.get(o)]
+
+# Columns modelled by the chained equations. Everything else in the MI outputs is derived from these.
+IMPUTE_COLS = P29_ITEMS + ["p29_global07"] + [o.replace("_raw", "_t_score") for o in P29_RAW]
+
+MI_ANALYSES = [
+    ("results_mi_raw_outputs", P29_COMPONENTS.get("OUTPUTS")),
+    ("results_mi_t_outputs", P29_COMPONENTS.get("OUTPUTS_t")),
+    ("results_mi_summary", ["p29_Mental_Health_Summ", "p29_Physical_Health_Summ"]),
+]
+
+
+class ImputedData:
+    """
+    Compact store of M imputations. base holds observed values with nan at every imputed cell; values[m] holds the
+    fill for those cells, in the row-major order of np.where(holes).
+    """
+
+    def __init__(self, index, columns, base, holes, values):
+        self.index = index
+        self.columns = list(columns)
+        self.base = base
+        self.holes = holes
+        self.values = values
+
+    @property
+    def m(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        return self.base.nbytes + self.holes.nbytes + self.values.nbytes
+
+    def complete(self, m):
+        X = self.base.copy()
+        X[self.holes] = self.values[m]
+        return X
+
+    def frame(self, m):
+        """
+        Patient frame of imputation m holding the imputed columns, passive raw scores and derived scores.
+        """
+        return derive_outputs(self.complete(m), self.columns, self.index)
+
+
+def derive_outputs(X, columns, index):
+    df = pd.DataFrame(X, index=index, columns=columns)
+    for raw in P29_RAW:
+        df[raw] = df[P29_COMPONENTS.get(raw)].sum(axis=1, min_count=len(P29_COMPONENTS.get(raw)))
+    return derive_p29_scores(df)
+
+
+def _fcs_chain(X, R, n_iter, donors, ridge, rng):
+    """
+    One chained-equations run with PMM. X: observed data (rows to impute only), R: cells to impute.
+    Returns imputed values of X[R].
+    """
+    Y = X.copy()
+    n = len(Y)
+    cols = [j for j in range(Y.shape[1]) if R[:, j].any()]
+
+    # Start from random draws of observed values.
+    for j in cols:
+        obs_vals = X[~R[:, j], j]
+        Y[R[:, j], j] = rng.choice(obs_vals, R[:, j].sum())
+
+    for _ in range(n_iter):
+        for j in cols:
+            obs, mis = ~R[:, j], R[:, j]
+            P = np.column_stack([np.ones(n), np.delete(Y, j, axis=1)])
+            A, y = P[obs], Y[obs, j]
+            q = A.shape[1]
+
+            # Ridge regularised least squares via QR of the augmented system; keeps collinear items (and T-scores
+            # that are functions of item sums) solvable.
+            Q, Rq = np.linalg.qr(np.vstack([A, np.sqrt(ridge) * np.eye(q)]))
+            beta = np.linalg.solve(Rq, Q[:len(A)].T @ y)
+            rss = np.sum((y - A @ beta) ** 2)
+
+            # Draw regression parameters from their approximate posterior, so that imputations reflect uncertainty
+            # in the imputation model.
+            sigma = np.sqrt(rss / rng.chisquare(max(len(y) - q, 1)))
+            beta_star = beta + sigma * np.linalg.solve(Rq, rng.standard_normal(q))
+
+            yhat_obs = A @ beta
+            yhat_mis = P[mis] @ beta_star
+
+            # Predictive mean matching: impute the observed value of a random one of the `donors` closest cases.
+            order = np.argsort(yhat_obs, kind="stable")
+            pos = np.searchsorted(yhat_obs[order], yhat_mis)
+            pick = np.clip(pos - donors // 2 + rng.integers(0, donors, len(pos)), 0, len(order) - 1)
+            Y[mis, j] = y[order[pick]]
+
+    return Y[R]
+
+
+def _group_stats(y, masks):
+    """
+    N, mean and sample variance of y within each category mask, ignoring nan.
+    """
+    ok = masks & ~np.isnan(y)[:, None]
+    n = ok.sum(axis=0)
+    yz = np.where(np.isnan(y), 0, y)
+    s = yz @ ok
+    ss = (yz ** 2) @ ok
+    mean = s / n
+    var = (ss - n * mean ** 2) / (n - 1)
+    return n, mean, var
+
+
+_WORKER = {}
+
+
+def _init_worker(X, R, columns, index, designs, n_iter, donors, ridge):
+    _WORKER.update(X=X, R=R, columns=columns, index=index, designs=designs, n_iter=n_iter, donors=donors,
+                   ridge=ridge)
+
+
+def _impute_and_analyse(m, seed):
+    """
+    Generate imputation m and return its fill values with per-group N, mean and variance of every analysed output.
+    """
+    w = _WORKER
+    rng = np.random.default_rng(seed)
+    R = w["R"]
+    rows = R.any(axis=1)
+    values = _fcs_chain(w["X"][rows], R[rows], w["n_iter"], w["donors"], w["ridge"], rng)
+
+    X = w["X"].copy()
+    X_rows = X[rows]
+    X_rows[R[rows]] = values
+    X[rows] = X_rows
+    frame = derive_outputs(X, w["columns"], w["index"])
+
+    group_stats = {}
+    for key, (masks, outputs) in w["designs"].items():
+        group_stats[key] = [_group_stats(frame[o].to_numpy(dtype=float), masks) for o in outputs]
+
+    return m, X[R], group_stats
+
+
+def pool_rubin(Q, U, df_com):
+    """
+    Rubin's rules. Q, U: (imputations, ...) estimates and their variances. Returns pooled estimate, total variance
+    and Barnard-Rubin degrees of freedom.
+    """
+    M = len(Q)
+    q_bar = np.mean(Q, axis=0)
+    u_bar = np.mean(U, axis=0)
+    b = np.var(Q, axis=0, ddof=1)
+    t = u_bar + (1 + 1 / M) * b
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lam = np.clip((1 + 1 / M) * b / t, 1e-12, 1)
+        df_old = (M - 1) / lam ** 2
+        df_obs = (df_com + 1) / (df_com + 3) * df_com * (1 - lam)
+        df = 1 / (1 / df_old + 1 / df_obs)
+    df = np.where(np.isfinite(df) & (df > 0) & (b > 0), df, df_com)
+    return q_bar, t, df
+
+
+def pool_f_d2(F, k1, df_com=np.inf):
+    """
+    D2 pooling (Li, Meng, Raghunathan & Rubin 1991) of per-imputation ANOVA F statistics with k1 numerator df.
+    Returns pooled statistic, denominator df and p-value. Without between-imputation variance this reduces to the
+    complete-data F test with df_com denominator df.
+    """
+    from scipy import stats
+
+    M = len(F)
+    d = np.asarray(F) * k1
+    r = (1 + 1 / M) * np.var(np.sqrt(d), ddof=1)
+    D2 = (np.mean(d) / k1 - (M + 1) / (M - 1) * r) / (1 + r)
+    D2 = max(D2, 0)
+    v2 = df_com if r == 0 else k1 ** (-3 / M) * (M - 1) * (1 + 1 / r) ** 2
+    return D2, v2, stats.f.sf(D2, k1, v2)
+
+
+def pool_anova(n, mean, var, p_thresh=0.05):
+    """
+    Pool one output over imputations. n: (k,) group sizes, mean, var: (imputations, k).
+    Pairwise p-values are only evaluated when the pooled omnibus test is significant, as in do_anova.
+    """
+    k = len(n)
+    N = np.sum(n)
+    gm = (mean @ n) / N
+    ssb = np.sum(n * (mean - gm[:, None]) ** 2, axis=1)
+    ssw = np.sum((n - 1) * var, axis=1)
+    mse = ssw / (N - k)
+    F = (ssb / (k - 1)) / mse
+
+    D2, v2, p = pool_f_d2(F, k - 1, N - k)
+    g_mean, g_t, g_df = pool_rubin(mean, var / n, n - 1)
+
+    # Tukey-style pairwise comparisons on pooled mean differences.
+    i, j = np.triu_indices(k, 1)
+    inv_n = 1 / n[i] + 1 / n[j]
+    d, d_t, d_df = pool_rubin(mean[:, i] - mean[:, j], mse[:, None] * inv_n, N - k)
+    q = np.abs(d) / np.sqrt(d_t / 2)
+    Pij = np.ones((k, k))
+    Dij = np.zeros((k, k))
+    if p < p_thresh:
+        from scipy import stats
+
+        Pij[i, j] = Pij[j, i] = stats.studentized_range.sf(q, k, d_df)
+    Dij[i, j], Dij[j, i] = d, -d
+
+    return dict(f=D2, df2=v2, p=p, n=n, mean=g_mean, se=np.sqrt(g_t), df=g_df, Pij=Pij, diff=Dij, F_m=F)
+
+
+def impute_p29(adf, m=20, workers=None, n_iter=10, donors=5, ridge=1e-5, min_observed=1, min_size=15,
+               p_thresh=0.05, analyses=MI_ANALYSES, seed=0):
+    """
+    Generate m imputations of the Promis-29 columns of adf in parallel worker processes and collect group statistics
+    for every prefix of PREFIX_TO_LABELS and every output set in analyses.
+
+    Patients with fewer than min_observed observed Promis-29 values are not imputed.
+    Returns ImputedData and {(result_dir, var_head): (categories, [per-output pooled results])}.
+    """
+    # Rubin's rules and D2 pool the between-imputation variance, which needs at least two imputations.
+    if m < 2:
+        raise ValueError("Pooling needs at least 2 imputations, got m = {0}.".format(m))
+    columns = [c for c in IMPUTE_COLS if c in adf.columns and adf[c].notna().sum() > 1]
+    X = adf[columns].to_numpy(dtype=float)
+    R = np.isnan(X) & (np.sum(~np.isnan(X), axis=1) >= min_observed)[:, None]
+
+    # Missingness after imputation is the same in every imputation, so category selection (min_size gate) can be
+    # done once on any completed frame.
+    derived = derive_outputs(np.where(R, np.nanmean(X, axis=0), X), columns, adf.index)
+    pattern = adf.drop(columns=derived.columns, errors="ignore").join(derived)
+
+    designs = dict()
+    categories = dict()
+    for result_dir, outputs in analyses:
+        for var_head, one_hot in PREFIX_IS_ONE_HOT.items():
+            cats = find_categories(var_head, outputs, pattern, one_hot, min_size)
+            if len(cats) < 2:
+                continue
+            designs[(result_dir, var_head)] = (category_masks(var_head, cats, pattern, one_hot), list(outputs))
+            categories[(result_dir, var_head)] = cats
+
+    seeds = np.random.SeedSequence(seed).generate_state(m)
+    values = np.empty((m, R.sum()))
+    collected = {key: [] for key in designs}
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(X, R, columns, adf.index, designs, n_iter, donors, ridge)) as pool:
+        for k, vals, group_stats in pool.map(_impute_and_analyse, range(m), seeds):
+            values[k] = vals
+            for key, gs in group_stats.items():
+                collected[key].append(gs)
+
+    pooled = dict()
+    for key, per_m in collected.items():
+        outputs = designs[key][1]
+        res = []
+        for o in range(len(outputs)):
+            n = per_m[0][o][0]
+            mean = np.array([gs[o][1] for gs in per_m])
+            var = np.array([gs[o][2] for gs in per_m])
+            res.append(pool_anova(n, mean, var, p_thresh))
+        pooled[key] = (categories[key], res)
+
+    return ImputedData(adf.index, columns, X, R, values), pooled
+
+
+def write_mi_report(var_head, categories, outputs, results, one_hot=True, p_thresh=0.05, result_dir="results_mi"):
+    """
+    Text and TSV report of pooled results, laid out as do_anova reports.
+    """
+    labeller = PREFIX_TO_LABELS.get(var_head)
+    cat_num = len(categories)
+    os.makedirs(result_dir, exist_ok=True)
+
+    outtxt = [var_head + " (multiple imputation, M = {0})\n".format(len(results[0]["F_m"]))]
+    outtxt.append("=========== Key ===========\n")
+    cat_labs = []
+    for k, C in enumerate(categories):
+        lab_num = category_label_num(var_head, C, one_hot)
+        lab = labeller.get(lab_num, lab_num)
+        cat_labs.append(str(lab))
+        outtxt.append("Group {0}: \t  {1}\n".format(k, lab))
+    outtxt.append('\n')
+
+    outcsv = ["\t".join([''] + cat_labs + ["ANOVA"])]
+
+    for output, r in zip(outputs, results):
+        p, f, Pij = r["p"], r["f"], r["Pij"]
+        outcsv_row = [output]
+        outtxt.append("\n\n##################################################\n")
+        outtxt.append(output + "\n\n")
+        outtxt.append("p = {0}\nf = {1}\ndf = ({2}, {3})\n".format(p, f, cat_num - 1, r["df2"]))
+        outtxt.append("\n")
+
+        diff_str = ['a' for _ in range(cat_num)]
+        if p < p_thresh:
+            outtxt.append("=========== P Values pooled Tukey HSD ===========\n")
+            for i in range(cat_num):
+                for j in range(i + 1, cat_num):
+                    outtxt.append("({0}, {1}): {2}\ndiff: {3}\n".format(i, j, Pij[i][j], r["diff"][i][j]))
+            outtxt.append('\n')
+            diff_str = getGroupLabels(Pij < p_thresh)
+
+        outtxt.append('=========== Pooled Summary ===========\n')
+        for k in range(cat_num):
+            outtxt.append("Group: {0}\nMean: {1}\nSE: {2}\ndf: {3}\nN: {4}\n".format(
+                k, r["mean"][k], r["se"][k], r["df"][k], r["n"][k]))
+            outcsv_row.append("{0} ({1}) N={2}".format(round(r["mean"][k], 2), diff_str[k], r["n"][k]))
+        outtxt.append('\n')
+
+        if p < p_thresh:
+            outcsv_row.append("p={0} f={1}".format(round(p, 4), round(f, 2)))
+        else:
+            outcsv_row.append("p>{0}".format(p_thresh))
+        outcsv.append("\t".join(outcsv_row))
+
+    with open("{0}/{1}_mi_anova_tHSD.txt".format(result_dir, var_head), 'w') as outfile:
+        for ln in outtxt:
+            outfile.write(ln)
+
+    with open("{0}/{1}_mi_anova_tHSD.tsv".format(result_dir, var_head), 'w') as outfile:
+        for ln in outcsv:
+            outfile.write(ln + "\n")
+
+
+def do_mi_anova(adf, m=20, workers=None, min_size=15, p_thresh=0.05, analyses=MI_ANALYSES, seed=0, **kwargs):
+    imputed, pooled = impute_p29(adf, m=m, workers=workers, min_size=min_size, p_thresh=p_thresh,
+                                 analyses=analyses, seed=seed, **kwargs)
+    outputs = dict(analyses)
+    for (result_dir, var_head), (categories, results) in pooled.items():
+        write_mi_report(var_head, categories, outputs[result_dir], results, one_hot=PREFIX_IS_ONE_HOT.get(var_head),
+                        p_thresh=p_thresh, result_dir=result_dir)
+    return imputed, pooled
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("data", nargs="?", default="npadata_race.csv")
+    parser.add_argument("-m", "--imputations", type=int, default=20)
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--min-size", type=int, default=15)
+    parser.add_argument("--p-thresh", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    imputed, _ = do_mi_anova(build_adf(load_data(args.data)), m=args.imputations, workers=args.workers,
+                             min_size=args.min_size, p_thresh=args.p_thresh, seed=args.seed, n_iter=args.iterations)
+    np.savez_compressed("npa_imputed.npz", index=imputed.index.to_numpy(), columns=imputed.columns,
+                        base=imputed.base, values=imputed.values)
+    print("{0} imputations, {1} imputed cells, {2:.1f} MB".format(imputed.m, imputed.values.shape[1],
+                                                                   imputed.nbytes / 2 ** 20))
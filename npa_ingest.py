@@ -0,0 +1,200 @@
+"""
+Incremental ingest of an append-only export. The state of the last run (per-patient frame, visit keys seen, tumor
+quantile edges and the StatsCube of every analysis of the spec) is kept in one pickle; on the next run only visits
+whose (pt_study_id, visit) key is new are derived, and only the analyses whose groups changed are rerun:
+
+    python npa_ingest.py npadata_race.csv --spec npa_spec.json --state npa_state.pkl
+
+The visit key is the VISIT_KEYS column(s) present in the export, or else the visit's position among the patient's rows,
+which relies on the export only ever appending rows. Per-patient values are the first non-null value over visits (as
+build_adf), so a patient's row can only be filled in by later visits: the updated row is the old row filled from the
+new visits. The cube is updated by removing the old rows of the affected patients and adding their updated rows, and
+an analysis is rerun only if its categories or their counts or sums changed. ANCOVA also depends on covariates, which
+are not in the cube, so an ANCOVA analysis is rerun for a prefix when a patient in its categories is new or changed in
+the outputs, covariates or the prefix. Tumor quantile edges are kept from the
+first run so tumor categories stay fixed. Use --rebuild after rows are edited or removed.
+"""
+__author__ = "Arjit M; amisra2@illinois.edu"
+__version__ = "Feb 2 2024"
+
+import os
+import re
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import npa_helpers
+from npa_consts import TUMOR_METRICS
+from npa_new import derive_symptom_totals, derive_p29_scores, load_data, build_adf, prepare_adf
+from npa_cube import StatsCube
+from npa_spec import load_spec, run_spec, resolve_outputs, resolve_analyses, SPEC_DEFAULTS
+
+VISIT_KEYS = ["redcap_event_name", "redcap_repeat_instance"]
+
+
+def visit_keys(df):
+    """
+    (pt_study_id, visit) key of every row.
+    """
+    cols = [c for c in VISIT_KEYS if c in df.columns]
+    if cols:
+        visit = df[cols].astype(str).agg("|".join, axis=1)
+    else:
+        visit = df.groupby("pt_study_id").cumcount().astype(str)
+    return pd.MultiIndex.from_arrays([df["pt_study_id"], visit], names=["pt_study_id", "visit"])
+
+
+def spec_output_sets(spec):
+    return {a["result_dir"]: resolve_outputs(a["outputs"]) for a in spec["analyses"]}
+
+
+def spec_min_sizes(spec):
+    defaults = dict(SPEC_DEFAULTS, **spec.get("defaults", dict()))
+    return {a["result_dir"]: a.get("min_size", defaults["min_size"]) for a in spec["analyses"]}
+
+
+def update_patients(adf, new, edges=None):
+    """
+    Patient rows of the affected patients after the visits in new (already derived), old rows filled from the first
+    non-null values of the new visits, with tumor metrics binned by edges if given. Returns (old rows, updated rows).
+    """
+    new_first = build_adf(new)
+    old = adf.loc[adf.index.intersection(new_first.index)]
+    updated = old.combine_first(new_first).reindex(columns=adf.columns)
+    updated["symptom_diff"] = updated["bsl_total"] - updated["fup_total"]
+
+    if edges:
+        tdf = npa_helpers.generateTumorDf(updated.reset_index(), path=None)
+        for metric in TUMOR_METRICS:
+            updated[metric] = tdf[metric]
+        npa_helpers.bin_tumor_metrics(updated, edges)
+    return old, updated
+
+
+def changed_groups(before, after, min_sizes):
+    """
+    (output set, prefix) pairs of after whose analysed categories or their counts, sums or sums of squares differ
+    from before. min_sizes: min_size of each output set.
+    """
+    changed = []
+    for set_name in after.output_sets:
+        min_size = min_sizes[set_name]
+        for var_head in after.prefixes:
+            keys, cube = after.group_cube(var_head, set_name, min_size)
+            if var_head not in before.prefixes:
+                changed.append((set_name, var_head))
+                continue
+            old_keys, old_cube = before.group_cube(var_head, set_name, min_size)
+            same = np.array_equal(keys, old_keys) and np.array_equal(cube.n, old_cube.n) and \
+                np.allclose(cube.s, old_cube.s) and np.allclose(cube.ss, old_cube.ss)
+            if not same:
+                changed.append((set_name, var_head))
+    return changed
+
+
+def changed_rows(before, after, columns):
+    """
+    Patients of after that are not in before or whose values in columns differ from before.
+    """
+    cols = [c for c in columns if c in after.columns]
+    old = before.reindex(index=after.index, columns=cols)
+    new = after[cols]
+    same = (old == new) | (old.isna() & new.isna())
+    return after.index[~same.all(axis=1)]
+
+
+def changed_ancova(spec, before, after, prefix_one_hot):
+    """
+    (result_dir, prefix) pairs of the spec's ANCOVA analyses with a new or changed patient in the prefix's
+    categories, comparing the outputs, covariates and prefix columns of the patient frames before and after.
+    """
+    changed = []
+    for a in resolve_analyses(spec):
+        if a["method"] != "ancova":
+            continue
+        for var_head in [v for v in a["prefixes"] if v in prefix_one_hot]:
+            if prefix_one_hot[var_head]:
+                cols = [c for c in after.columns if re.match("{0}_*\\d+".format(var_head), c)]
+            else:
+                cols = [var_head] if var_head in after.columns else []
+            rows = changed_rows(before, after, a["outputs"] + list(a["covariates"]) + cols)
+            member = after.loc[rows, cols] == 1 if prefix_one_hot[var_head] else after.loc[rows, cols].notna()
+            if member.to_numpy().any():
+                changed.append((a["result_dir"], var_head))
+    return changed
+
+
+def rebuild(path, spec):
+    df = load_data(path)
+    adf, prefix_labels, prefix_one_hot, edges = prepare_adf(df, spec.get("tumor_bins", True))
+    return dict(adf=adf, prefix_labels=prefix_labels, prefix_one_hot=prefix_one_hot, keys=visit_keys(df), edges=edges,
+                cube=StatsCube.build(adf, spec_output_sets(spec), prefix_one_hot))
+
+
+def ingest(path, state):
+    """
+    Apply the visits of the export at path that are not in state. Returns the updated state and the number of new
+    visits.
+    """
+    df = pd.read_csv(path)
+    keys = visit_keys(df)
+    added = ~keys.isin(state["keys"])
+    if not added.any():
+        return state, 0
+
+    new = df.loc[added].copy()
+    derive_symptom_totals(new)
+    derive_p29_scores(new)
+
+    old, updated = update_patients(state["adf"], new, state["edges"])
+
+    adf = pd.concat([state["adf"].drop(old.index), updated]).sort_index()
+    cube = state["cube"] - StatsCube.build(old, state["cube"].output_sets, state["prefix_one_hot"]) + \
+        StatsCube.build(updated, state["cube"].output_sets, state["prefix_one_hot"])
+    return dict(state, adf=adf, keys=keys, cube=cube), int(added.sum())
+
+
+def run_changed(spec, state, changed=None, workers=None):
+    """
+    Rerun the spec's analyses, restricted to the changed (result_dir, prefix) pairs if given, on the in-memory
+    patient frame.
+    """
+    spec = dict(spec, expanded=None)
+    if changed is not None:
+        spec["analyses"] = [dict(a, prefixes=[v for d, v in changed if d == a["result_dir"]])
+                            for a in spec["analyses"]]
+    data = spec.get("data", "npadata_race.csv")
+    prepared = (state["adf"], state["prefix_labels"], state["prefix_one_hot"], state["edges"])
+    return run_spec(spec, workers, done={("load", data): None, ("adf", data): prepared})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest visits added to an export since the last run.")
+    parser.add_argument("data", nargs="?", default="npadata_race.csv")
+    parser.add_argument("--spec", default="npa_spec.json")
+    parser.add_argument("--state", default="npa_state.pkl")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the state and all results from scratch.")
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    spec = dict(load_spec(args.spec), data=args.data)
+
+    if args.rebuild or not os.path.exists(args.state):
+        state = rebuild(args.data, spec)
+        print("Built state from {0} visits".format(len(state["keys"])))
+        state["adf"].to_csv(spec.get("expanded") or "npa_expanded.csv")
+        run_changed(spec, state, None, args.workers)
+    else:
+        before = pd.read_pickle(args.state)
+        state, n_new = ingest(args.data, before)
+        changed = []
+        if n_new:
+            changed = changed_groups(before["cube"], state["cube"], spec_min_sizes(spec))
+            changed += [c for c in changed_ancova(spec, before["adf"], state["adf"], state["prefix_one_hot"])
+                        if c not in changed]
+        print("{0} new visits, {1} analyses to update".format(n_new, len(changed)))
+        if changed:
+            state["adf"].to_csv(spec.get("expanded") or "npa_expanded.csv")
+            run_changed(spec, state, changed, args.workers)
+    pd.to_pickle(state, args.state)
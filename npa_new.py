@@ -7,76 +7,108 @@ __version__ = "Feb 2 2024"
 import numpy as np
 import pandas as pd
 import re
-from matplotlib import pyplot as plt
-import seaborn as sns
-from scipy import stats
 import os
-from npa_consts import P29_COMPONENTS, FUP_LOC, FUP_RES, TUMOR_VARS, PREFIX_TO_LABELS, PREFIX_IS_ONE_HOT, \
-    PHYS_HLTH_SUMMARY, MENT_HLTH_SUMMARY
+import argparse
+from npa_consts import FUP_LOC, FUP_RES, TUMOR_VARS, PREFIX_TO_LABELS, PREFIX_IS_ONE_HOT, \
+    PHYS_HLTH_SUMMARY, MENT_HLTH_SUMMARY, OUTPUT_SETS, OUTPUT_LIMITS, ANCOVA_COVARIATES
 from npa_helpers import *
+from npa_report import FigureReport, REPORT_FORMATS
+from npa_nonparam import RankEngine
+from npa_cube import GroupCube
+from npa_summary import GroupSummary, write_summary
+from npa_symptoms import SymptomSets
+from npa_effect import write_effect_sizes, sweep_cube_power, write_power_tables
 
 # http://www.healthmeasures.net/media/kunena/attachments/257/PROMIS29_Scoring_08082018.pdf
 PAIN_INT_MEAN = 2.31
 PAIN_INT_STD = 2.34
 
-df = pd.read_csv("npadata_race.csv")
-col_names = df.columns.to_numpy()
-fup_cols = [c for c in col_names if re.match("fup_symptoms___\d*", c)]
-bsl_cols = [c for c in col_names if re.match("bsl_symptoms___\d*", c)]
-fup_total = np.sum(df[fup_cols], axis=1)
-fup_total[~np.any(df[fup_cols], axis=1)] = np.nan
 
-bsl_total = np.sum(df[bsl_cols], axis=1)
-bsl_total[~np.any(df[bsl_cols], axis=1)] = np.nan
-
-df["fup_total"] = fup_total
-df["bsl_total"] = bsl_total
-
-# Convert t_scores to z_scores. Here, T mean is 50 and std is 10.
-df['p29_pf_z_score'] = ( df['p29_pf_t_score'] - 50 ) / 10
-df['p29_anxiety_z_score'] = ( df['p29_anxiety_t_score'] - 50 ) / 10
-df['p29_depression_z_score'] = ( df['p29_depression_t_score'] - 50 ) / 10
-df['p29_fatigue_z_score'] = ( df['p29_fatigue_t_score'] - 50 ) / 10
-df['p29_sd_z_score'] = ( df['p29_sd_t_score'] - 50 ) / 10
-df['p29_social_z_score'] = ( df['p29_social_t_score'] - 50 ) / 10
-df['p29_pain_z_score'] = ( df['p29_pain_t_score'] - 50 ) / 10
-
-df['p29_pain_int_z_score'] = (df['p29_global07'] - PAIN_INT_MEAN) / PAIN_INT_STD
-df['p29_pain_int_t_score'] = df['p29_pain_int_z_score'] * 10 + 50
-
-df['pain_avg_z'] = np.mean(df[['p29_pain_int_z_score', 'p29_pain_z_score']], axis=1)
-
-df['emotional_dist_z'] = np.mean(df[['p29_depression_z_score', 'p29_anxiety_z_score']], axis=1)
-
-summ_in = df[[
-    'p29_pf_z_score',
-    'pain_avg_z',
-    'p29_social_z_score',
-    'p29_fatigue_z_score',
-    'p29_sd_z_score',
-    'emotional_dist_z',
-]]
-
-df["p29_Mental_Health_Summ"] = (MENT_HLTH_SUMMARY @ summ_in.T) * 10 + 50
-df["p29_Physical_Health_Summ"] = (PHYS_HLTH_SUMMARY @ summ_in.T) * 10 + 50
-
-col_names = df.columns.to_numpy()
-
-adf = df.groupby("pt_study_id").first()
-adf = adf.copy()
-adf["symptom_diff"] = adf["bsl_total"] - adf["fup_total"]
-
-adf.to_csv("npa_expanded.csv")
-
-def do_anova(var_head, outputs, out_max, one_hot=True, min_size=15, p_thresh=0.05, result_dir='results_point',
-             out_min=None, plot_mode=True):
-
-    num_out = len(outputs)
+def derive_symptom_totals(df):
+    """
+    Count of baseline and follow-up symptoms per visit. Visits with no symptom checked are nan.
+    """
+    sets = SymptomSets.from_frame(df)
+    df["fup_total"] = sets.totals("fup")
+    df["bsl_total"] = sets.totals("bsl")
+    return df
+
+
+def derive_p29_scores(df):
+    """
+    Z-scores, pain interference and mental/physical health summaries from Promis-29 T-scores. Row-wise, so may be
+    applied to visit-level or patient-level frames alike.
+    """
+    # Convert t_scores to z_scores. Here, T mean is 50 and std is 10.
+    df['p29_pf_z_score'] = ( df['p29_pf_t_score'] - 50 ) / 10
+    df['p29_anxiety_z_score'] = ( df['p29_anxiety_t_score'] - 50 ) / 10
+    df['p29_depression_z_score'] = ( df['p29_depression_t_score'] - 50 ) / 10
+    df['p29_fatigue_z_score'] = ( df['p29_fatigue_t_score'] - 50 ) / 10
+    df['p29_sd_z_score'] = ( df['p29_sd_t_score'] - 50 ) / 10
+    df['p29_social_z_score'] = ( df['p29_social_t_score'] - 50 ) / 10
+    df['p29_pain_z_score'] = ( df['p29_pain_t_score'] - 50 ) / 10
+
+    df['p29_pain_int_z_score'] = (df['p29_global07'] - PAIN_INT_MEAN) / PAIN_INT_STD
+    df['p29_pain_int_t_score'] = df['p29_pain_int_z_score'] * 10 + 50
+
+    df['pain_avg_z'] = np.mean(df[['p29_pain_int_z_score', 'p29_pain_z_score']], axis=1)
+
+    df['emotional_dist_z'] = np.mean(df[['p29_depression_z_score', 'p29_anxiety_z_score']], axis=1)
+
+    summ_in = df[[
+        'p29_pf_z_score',
+        'pain_avg_z',
+        'p29_social_z_score',
+        'p29_fatigue_z_score',
+        'p29_sd_z_score',
+        'emotional_dist_z',
+    ]]
+
+    df["p29_Mental_Health_Summ"] = (MENT_HLTH_SUMMARY @ summ_in.T) * 10 + 50
+    df["p29_Physical_Health_Summ"] = (PHYS_HLTH_SUMMARY @ summ_in.T) * 10 + 50
+    return df
+
+
+def load_data(path="npadata_race.csv"):
+    df = pd.read_csv(path)
+    derive_symptom_totals(df)
+    derive_p29_scores(df)
+    return df
+
+
+def build_adf(df):
+    """
+    One row per patient, indexed by pt_study_id.
+    """
+    adf = df.groupby("pt_study_id").first()
+    adf = adf.copy()
+    adf["symptom_diff"] = adf["bsl_total"] - adf["fup_total"]
+    return adf
+
+
+def prepare_adf(df, tumor_bins=True, edges=None):
+    """
+    Per-patient frame with tumor metrics joined, the labels and one-hot flags of every prefix to analyse, including
+    the tumor size quantile prefixes, and the tumor bin edges used. edges: {metric: bin edges} to reuse, see
+    bin_tumor_metrics.
+    """
+    adf = build_adf(df)
+    if not tumor_bins:
+        return adf, dict(PREFIX_TO_LABELS), dict(PREFIX_IS_ONE_HOT), dict()
+
+    # Tumor size categories are run through the sweep like any other integer-coded prefix.
+    adf = join_tumor_metrics(adf, df)
+    tumor_labels, edges = bin_tumor_metrics(adf, edges)
+    prefix_labels = dict(PREFIX_TO_LABELS, **tumor_labels)
+    prefix_one_hot = dict(PREFIX_IS_ONE_HOT, **{var: False for var in prefix_labels if var not in PREFIX_IS_ONE_HOT})
+    return adf, prefix_labels, prefix_one_hot, edges
+
+
+def find_categories(var_head, outputs, data, one_hot=True, min_size=15):
+    """
+    Categories of a variable for which sufficient data exists, i.e. more than min_size entries with non-nan outputs.
+    """
     outputs = list(outputs)
-
-    if not out_min:
-        out_min = [0] * num_out
-
     categories = []
 
     if one_hot:
@@ -84,10 +116,10 @@ def do_anova(var_head, outputs, out_max, one_hot=True, min_size=15, p_thresh=0.0
         # e.g. tumor_loc___3 refers to a specific tumor location.
         # Here, isolate categories (__x) for a variable (tumor_loc) for which sufficient data exists, at least
         # MIN_SIZE entries with non-nan outputs
-        for col in col_names:
+        for col in data.columns:
             M = re.match("{0}_*\d+".format(var_head), col)
             if M:
-                if len(adf.loc[adf[M.string] == 1][outputs].dropna()) > min_size:
+                if len(data.loc[data[M.string] == 1][outputs].dropna()) > min_size:
                     categories.append(M.string)
 
     else:
@@ -95,9 +127,115 @@ def do_anova(var_head, outputs, out_max, one_hot=True, min_size=15, p_thresh=0.0
         # e.g. metastatic_no = 5 refers to a specific non-metastatic tumor.
         # Here, isolate categories (x) corresponding to variable (metastatic_no) for which sufficient data exists,
         # at least MIN_SIZE entries with non-nan outputs.
-        categories = [C for C, n in zip(*np.unique(adf[var_head], return_counts=True)) if n > min_size]
-        categories = [C for C in categories if len(adf.loc[adf[var_head] == C][outputs].dropna()) > min_size]
+        categories = [C for C, n in zip(*np.unique(data[var_head], return_counts=True)) if n > min_size]
+        categories = [C for C in categories if len(data.loc[data[var_head] == C][outputs].dropna()) > min_size]
+
+    return categories
+
+
+def category_masks(var_head, categories, data, one_hot=True):
+    """
+    Boolean membership matrix of shape (patients, categories). One-hot categories may overlap.
+    """
+    if one_hot:
+        cols = [(data[C] == 1).to_numpy() for C in categories]
+    else:
+        cols = [(data[var_head] == C).to_numpy() for C in categories]
+    return np.column_stack(cols) if cols else np.zeros((len(data), 0), dtype=bool)
+
+
+def category_label_num(var_head, C, one_hot=True):
+    """
+    Integer key of a category in PREFIX_TO_LABELS.
+    """
+    if one_hot:
+        return int(re.match("{0}_+(\d+)".format(var_head), C).group(1))
+    # If dictionary is empty, simply use value in database. Useful for variables whose numerical values are
+    # not group numbers e.g. number of lesions.
+    return int(C)
+
+
+# Omnibus test, its statistic, post-hoc test, pairwise statistic and result file suffix for each do_anova method.
+METHODS = {
+    "anova": ("ANOVA", "f", "Tukey HSD", "t", "anova_tHSD"),
+    "kruskal": ("Kruskal-Wallis", "H", "Dunn", "z", "kruskal_dunn"),
+}
+
+# ANOVA backends of do_anova. reference: scipy.stats.f_oneway and tukey_hsd on the arrays of every group, the path of
+# the published results; fast: the same tests from the GroupCube's counts and sums, without building group arrays;
+# check: reference results, plus the differences of the fast backend written to {var}_backend_check.tsv.
+BACKENDS = ("reference", "fast", "check")
+BACKEND_CHECK_COLUMNS = ["output", "f", "fast f", "|f diff| / f", "p", "fast p", "|p diff|", "max |Tukey p diff|",
+                         "max |mean diff diff|", "same significance", "same letters"]
+
+
+def backend_differences(output, to, cube, out_i, p_thresh=0.05):
+    """
+    Reference and fast ANOVA and Tukey HSD of one output, as one row of BACKEND_CHECK_COLUMNS. Tukey HSD is compared
+    whatever the ANOVA p-value.
+    """
+    from scipy import stats
+
+    f, p = stats.f_oneway(*to)
+    res = stats.tukey_hsd(*to)
+    fast = cube.anova()
+    fast_f, fast_p = fast["f"][out_i], fast["p"][out_i]
+    Pij, T = cube.tukey(out_i)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rel_f = abs(f - fast_f) / abs(f)
+    return [output, f, fast_f, rel_f, p, fast_p, abs(p - fast_p), np.max(np.abs(res.pvalue - Pij)),
+            np.max(np.abs(res.statistic - T)), (p < p_thresh) == (fast_p < p_thresh),
+            getGroupLabels(res.pvalue < p_thresh) == getGroupLabels(Pij < p_thresh)]
+
+
+def write_backend_check(units, path="backend_check.tsv"):
+    """
+    Stack the {var}_backend_check.tsv of the checked (result_dir, prefix) units into one table. Returns a one-line
+    summary of the largest differences and the number of outputs whose significance or letter groups differ.
+    """
+    tables = []
+    for result_dir, var_head in units:
+        unit_path = "{0}/{1}_backend_check.tsv".format(result_dir, var_head)
+        if os.path.exists(unit_path):
+            tables.append(pd.read_csv(unit_path, sep="\t").assign(result_dir=result_dir, prefix=var_head))
+    if not tables:
+        return "No backend checks were run."
+
+    table = pd.concat(tables, ignore_index=True)[["result_dir", "prefix"] + BACKEND_CHECK_COLUMNS]
+    table.to_csv(path, sep="\t", index=False)
+    return "{0} outputs of {1} analyses checked: max |f diff| / f = {2:.3g}, max |p diff| = {3:.3g}, " \
+           "max |Tukey p diff| = {4:.3g}; significance differs for {5}, letters for {6}".format(
+               len(table), len(tables), table["|f diff| / f"].max(), table["|p diff|"].max(),
+               table["max |Tukey p diff|"].max(), int((~table["same significance"]).sum()),
+               int((~table["same letters"]).sum()))
+
+
+def do_anova(var_head, outputs, out_max, data, one_hot=True, min_size=15, p_thresh=0.05, result_dir='results_point',
+             out_min=None, plot_mode=True, report=None, labels=None, method="anova", effect_sizes=True,
+             categories=None, masks=None, summary_table=True, backend="reference", cube=None, ranks=None):
+
+    # Plotting and scipy.stats are imported here rather than at module level; with plot_mode=False matplotlib and
+    # seaborn are never loaded.
+    from scipy import stats
+    if plot_mode:
+        from matplotlib import pyplot as plt
 
+    if method not in METHODS:
+        raise ValueError("Unknown method {0}. Expected one of {1}".format(method, list(METHODS)))
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend {0}. Expected one of {1}".format(backend, list(BACKENDS)))
+    test_name, stat_name, posthoc_name, pair_stat, file_suffix = METHODS.get(method)
+
+    num_out = len(outputs)
+    outputs = list(outputs)
+
+    if not out_min:
+        out_min = [0] * num_out
+
+    # Categories, their masks and their GroupCube may be passed in when already computed for the same outputs and
+    # min_size; ranks is the RankEngine of data, held by a sweep so each output is ranked once across prefixes.
+    if categories is None:
+        categories = find_categories(var_head, outputs, data, one_hot, min_size)
 
     cat_num = len(categories)
 
@@ -105,8 +243,22 @@ def do_anova(var_head, outputs, out_max, one_hot=True, min_size=15, p_thresh=0.0
         print("{0} ANOVA not performed. Insuffucient categories.".format(var_head))
         return
 
+    if masks is None:
+        masks = category_masks(var_head, categories, data, one_hot)
+    values = data[list(outputs)].to_numpy(dtype=float)
+    if cube is None:
+        cube = GroupCube.from_masks(values, masks, outputs)
+    if method == "kruskal" and ranks is None:
+        ranks = RankEngine(data)
+    summary = GroupSummary.from_cube(cube, values, masks)
+
+    # Kruskal-Wallis always runs on the rank engine; the backend only selects how ANOVA and Tukey HSD are computed.
+    fast = backend == "fast" and method == "anova"
+    omnibus = cube.anova() if fast else None
+    checks = []
+
     # Physical meaning of integer value.
-    labeller = PREFIX_TO_LABELS.get(var_head)
+    labeller = labels if labels is not None else PREFIX_TO_LABELS.get(var_head)
 
     # If results folder does not exist, create folder in CWD.
     os.makedirs("{0}/{1}".format(result_dir, var_head), exist_ok=True)
@@ -115,7 +267,7 @@ def do_anova(var_head, outputs, out_max, one_hot=True, min_size=15, p_thresh=0.0
     outcsv = []
     if plot_mode:
         fig, ax = plt.subplots( (num_out + 1) // 2 , 2, figsize=(19.2, 7 * ((num_out + 1) // 2)), sharex="all")
-    plt.yticks()
+        plt.yticks()
 
     lgnd_txt = ""
     outtxt.append(var_head + "\n")
@@ -124,13 +276,7 @@ def do_anova(var_head, outputs, out_max, one_hot=True, min_size=15, p_thresh=0.0
     cat_labs = []
 
     for k, C in enumerate(categories):
-        if one_hot:
-            lab_num = int(re.match("{0}_+(\d+)".format(var_head), C).group(1))
-        else:
-            # If dictionary is empty, simply use value in database. Useful for variables whose numerical values are
-            # not group numbers e.g. number of lesions.
-            lab_num = int(C)
-
+        lab_num = category_label_num(var_head, C, one_hot)
         lab = labeller.get(lab_num, lab_num)
         catnum_to_labnum[k] = lab_num
         cat_labs.append(str(lab))
@@ -141,7 +287,7 @@ def do_anova(var_head, outputs, out_max, one_hot=True, min_size=15, p_thresh=0.0
     labnum_to_catnum = {v:k for k, v in catnum_to_labnum.items()}
 
     # Initialize first row of output csv with blank column, then names of categories as columns
-    outcsv.append("\t".join([''] + cat_labs + ["ANOVA"]))
+    outcsv.append("\t".join([''] + cat_labs + [test_name]))
 
     '''
     Map for formatting. Given 3-4 plots, want label to be at height = 1/6 of figure.
@@ -158,25 +304,37 @@ def do_anova(var_head, outputs, out_max, one_hot=True, min_size=15, p_thresh=0.0
     for out_i, output in enumerate(outputs):
 
         outcsv_row = [output]
+        # Group arrays are only needed by the reference backend and by the plots.
         to = []
-        for C in categories:
-            if one_hot:
-                to.append(adf.loc[adf[C] == 1][output].dropna().to_numpy())
-            else:
-                to.append(adf.loc[adf[var_head] == C][output].dropna().to_numpy())
-
-        # ANOVA with all groups.
-        f, p = stats.f_oneway(*to)
+        if plot_mode or not fast:
+            for C in categories:
+                if one_hot:
+                    to.append(data.loc[data[C] == 1][output].dropna().to_numpy())
+                else:
+                    to.append(data.loc[data[var_head] == C][output].dropna().to_numpy())
+
+        # ANOVA (or Kruskal-Wallis) with all groups.
+        if method == "kruskal":
+            f, p, T, Pij, mean_rank = ranks.kruskal_dunn(output, masks)
+        elif fast:
+            f, p = omnibus["f"][out_i], omnibus["p"][out_i]
+        else:
+            f, p = stats.f_oneway(*to)
+        if backend == "check" and method == "anova":
+            checks.append(backend_differences(output, to, cube, out_i, p_thresh))
         outtxt.append("\n\n##################################################\n")
         outtxt.append(output + "\n\n")
-        outtxt.append("p = {0}\nf = {1}\n".format(p, f))
+        outtxt.append("p = {0}\n{1} = {2}\n".format(p, stat_name, f))
         outtxt.append("\n")
 
         diff_str = ['a' for _ in range(cat_num)]
         if p < p_thresh:
-            res = stats.tukey_hsd(*to)
-            Pij, T = res.pvalue, res.statistic
-            outtxt.append("=========== P Values Tukey HSD ===========\n")
+            if fast:
+                Pij, T = cube.tukey(out_i)
+            elif method == "anova":
+                res = stats.tukey_hsd(*to)
+                Pij, T = res.pvalue, res.statistic
+            outtxt.append("=========== P Values {0} ===========\n".format(posthoc_name))
             outtxt.append("_________________ All ____________________\n")
             for i in range(cat_num):
                 for j in range(i + 1, cat_num):
@@ -187,7 +345,8 @@ def do_anova(var_head, outputs, out_max, one_hot=True, min_size=15, p_thresh=0.0
             for i in range(cat_num):
                 for j in range(i + 1, cat_num):
                     if Pij[i][j] < p_thresh:
-                        outtxt.append("({0}, {1})\np: {2}\nt: {3}\n".format(i, j, str(Pij[i][j]), str(T[i][j])))
+                        outtxt.append("({0}, {1})\np: {2}\n{3}: {4}\n".format(i, j, str(Pij[i][j]), pair_stat,
+                                                                           str(T[i][j])))
 
             outtxt.append('\n')
 
@@ -199,79 +358,159 @@ def do_anova(var_head, outputs, out_max, one_hot=True, min_size=15, p_thresh=0.0
                     lab = labeller.get(int(re.match("{0}_+(\d+)".format(var_head), C).group(1)))
                 else:
                     lab = labeller.get(int(C), int(C))
-                outtxt.append("{0}^({1})\nN = {2}\n".format(lab, diff_str[k], len(to[k])))
+                outtxt.append("{0}^({1})\nN = {2}\n".format(lab, diff_str[k], int(summary.n[k, out_i])))
             outtxt.append("\n")
 
         else:
             pass
 
         outtxt.append('=========== Summary ===========\n')
-        for k, v in enumerate(to):
-            outtxt.append("Group: {0}\nMean: {1}\nStd: {2}\nN: {3}\n".format(k, np.mean(v), np.std(v), len(v)))
-            outcsv_row.append("{0} ({1}) N={2}".format(round(np.mean(v), 2), diff_str[k], len(v)))
+        mean, std, n = summary.mean[:, out_i], summary.std[:, out_i], summary.n[:, out_i].astype(int)
+        for k in range(cat_num):
+            outtxt.append("Group: {0}\nMean: {1}\nStd: {2}\nN: {3}\n".format(k, mean[k], std[k], n[k]))
+            if method == "kruskal":
+                outtxt.append("Mean rank: {0}\n".format(mean_rank[k]))
+            outcsv_row.append("{0} ({1}) N={2}".format(round(mean[k], 2), diff_str[k], n[k]))
 
         outtxt.append('\n')
         if p < p_thresh:
-            outcsv_row.append("p={0} f={1}".format(round(p, 4), round(f, 2)))
+            outcsv_row.append("p={0} {1}={2}".format(round(p, 4), stat_name, round(f, 2)))
         else:
             outcsv_row.append("p>{0}".format(p_thresh))
         outcsv.append("\t".join(outcsv_row))
 
         if plot_mode:
             make_ind_plots(num_out, ax, out_i, out_max, out_min, output, to, catnum_to_labnum, labnum_to_catnum,
-                           labeller, result_dir, var_head, diff_str)
+                           labeller, result_dir, var_head, diff_str, report, summary.order[:, out_i])
         # End for each output
 
     if plot_mode:
         fig.suptitle(var_head)
-        fig.savefig("{0}/{1}.jpg".format(result_dir, var_head), dpi=600)
-        plt.close()
+        if report is not None:
+            report.add(fig, var_head)
+        else:
+            fig.savefig("{0}/{1}.jpg".format(result_dir, var_head), dpi=600)
+            plt.close(fig)
 
-    with open("{0}/{1}_anova_tHSD.txt".format(result_dir, var_head), 'w') as outfile:
+    with open("{0}/{1}_{2}.txt".format(result_dir, var_head, file_suffix), 'w') as outfile:
         for ln in outtxt:
             outfile.write(ln)
 
-    with open("{0}/{1}_anova_tHSD.tsv".format(result_dir, var_head), 'w') as outfile:
+    with open("{0}/{1}_{2}.tsv".format(result_dir, var_head, file_suffix), 'w') as outfile:
         for ln in outcsv:
             outfile.write(ln + "\n")
 
-
-for var in PREFIX_TO_LABELS.keys():
-    print(var)
-    do_anova(
-        var,
-        P29_COMPONENTS.get("OUTPUTS"),
-        P29_COMPONENTS.get("OUTPUT_MAX"),
-        result_dir="results_raw_outputs",
-        one_hot=PREFIX_IS_ONE_HOT.get(var)
-    )
-
-    do_anova(
-        var,
-        P29_COMPONENTS.get("OUTPUTS_t"),
-        [100] * len(P29_COMPONENTS.get("OUTPUTS_t")),
-        result_dir="results_t_outputs",
-        one_hot=PREFIX_IS_ONE_HOT.get(var)
-    )
-
-    do_anova(
-        var,
-        ["p29_Mental_Health_Summ", "p29_Physical_Health_Summ"],
-        [100,100],
-        result_dir="results_summary",
-        one_hot=PREFIX_IS_ONE_HOT.get(var)
-    )
-
-    do_anova(
-        var,
-        ["fup_total", "bsl_total", "symptom_diff"],
-        out_max=[10, 10, 5],
-        one_hot=PREFIX_IS_ONE_HOT.get(var),
-        result_dir="results_symptoms",
-        out_min=[0, 0, -5],
-    )
-
-
-
-
-
+    # Effect sizes are those of the one-way ANOVA, so a Kruskal-Wallis run writes none.
+    if effect_sizes and method == "anova":
+        write_effect_sizes("{0}/{1}_effect_sizes.tsv".format(result_dir, var_head), cube, cat_labs)
+    if summary_table:
+        write_summary("{0}/{1}_summary.tsv".format(result_dir, var_head), summary, cat_labs)
+    if checks:
+        with open("{0}/{1}_backend_check.tsv".format(result_dir, var_head), 'w') as outfile:
+            outfile.write("\t".join(BACKEND_CHECK_COLUMNS) + "\n")
+            for row in checks:
+                outfile.write("\t".join(str(x) for x in row) + "\n")
+
+    return cube
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="One-way ANOVA / Tukey HSD of NPA outcomes by every prefix.")
+    parser.add_argument("data", nargs="?", default="npadata_race.csv")
+    parser.add_argument("--stats-only", action="store_true",
+                        help="Write text/TSV results only; plotting libraries are never imported.")
+    parser.add_argument("--report", choices=REPORT_FORMATS, default=None,
+                        help="Collect all figures of a result directory in one multi-page PDF, or an SVG/raster set "
+                             "at --dpi, instead of one 600 dpi JPEG per figure.")
+    parser.add_argument("--dpi", type=int, default=150, help="Resolution of raster reports.")
+    parser.add_argument("--method", choices=list(METHODS), default="anova",
+                        help="anova: one-way ANOVA with Tukey HSD; kruskal: Kruskal-Wallis with Dunn's test.")
+    parser.add_argument("--power", type=int, default=0, metavar="SIMS",
+                        help="Monte Carlo power of every ANOVA with SIMS simulations, written to "
+                             "<result_dir>/power.tsv")
+    parser.add_argument("--ancova", action="store_true",
+                        help="Also compare covariate-adjusted means (ANCOVA), written to <result_dir>_ancova.")
+    parser.add_argument("--covariates", nargs="+", default=ANCOVA_COVARIATES)
+    parser.add_argument("--stratify-by", metavar="COLUMN", default=None,
+                        help="Repeat the sweep within every level of an integer-coded COLUMN, in parallel, written "
+                             "to results_by_<COLUMN> with one combined table.")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Worker processes of --stratify-by.")
+    parser.add_argument("--backend", choices=BACKENDS[:2], default="reference",
+                        help="reference: scipy.stats on the group arrays; fast: from per-group counts and sums.")
+    parser.add_argument("--cross-check", type=int, default=0, metavar="UNITS",
+                        help="Run UNITS randomly sampled (prefix, output set) analyses with both backends, keep the "
+                             "reference results and write their differences to backend_check.tsv.")
+    args = parser.parse_args()
+    plot_mode = not args.stats_only
+
+    # Strata are swept in worker processes, which write their own figures and no report, ANCOVA, power or check.
+    if args.stratify_by:
+        unsupported = [flag for flag, on in [("--report", args.report), ("--ancova", args.ancova),
+                                             ("--power", args.power), ("--cross-check", args.cross_check)] if on]
+        if unsupported:
+            parser.error("--stratify-by cannot be combined with {0}".format(", ".join(unsupported)))
+
+    # Power is that of the one-way ANOVA F test.
+    if args.power and args.method != "anova":
+        parser.error("--power is the power of the ANOVA F test and cannot be combined with --method {0}".format(
+            args.method))
+
+    if args.ancova:
+        from npa_ancova import do_ancova
+
+    df = load_data(args.data)
+
+    adf, prefix_labels, prefix_one_hot, _ = prepare_adf(df)
+    adf.to_csv("npa_expanded.csv")
+
+    if args.stratify_by:
+        from npa_strata import sweep_strata
+
+        print(sweep_strata(adf, prefix_labels, prefix_one_hot, args.stratify_by, workers=args.workers,
+                           method=args.method, plot_mode=plot_mode, backend=args.backend))
+        raise SystemExit
+
+    reports = dict()
+    if plot_mode and args.report:
+        reports = {d: FigureReport(d, args.report, args.dpi) for d in OUTPUT_SETS}
+
+    units = [(result_dir, var) for var in prefix_labels for result_dir in OUTPUT_SETS]
+    rng = np.random.default_rng(0)
+    checked = [units[i] for i in sorted(rng.choice(len(units), min(args.cross_check, len(units)), replace=False))]
+
+    cubes = dict()
+    ranks = RankEngine(adf)
+    for var in prefix_labels.keys():
+        print(var)
+        for result_dir, outputs in OUTPUT_SETS.items():
+            out_max, out_min = OUTPUT_LIMITS.get(result_dir)
+            cubes[(result_dir, var)] = do_anova(
+                var,
+                outputs,
+                out_max,
+                adf,
+                one_hot=prefix_one_hot.get(var),
+                labels=prefix_labels.get(var),
+                result_dir=result_dir,
+                out_min=out_min,
+                plot_mode=plot_mode,
+                method=args.method,
+                report=reports.get(result_dir),
+                backend="check" if (result_dir, var) in checked else args.backend,
+                ranks=ranks,
+            )
+
+        if args.ancova:
+            for result_dir, outputs in OUTPUT_SETS.items():
+                do_ancova(var, outputs, adf, prefix_one_hot.get(var), args.covariates,
+                          result_dir=result_dir + "_ancova", labels=prefix_labels.get(var))
+
+    for report in reports.values():
+        report.close()
+
+    if checked:
+        print(write_backend_check(checked))
+
+    if args.power:
+        cubes = {k: v for k, v in cubes.items() if v is not None}
+        write_power_tables(sweep_cube_power(cubes, sims=args.power), args.power)
@@ -0,0 +1,101 @@
+"""
+Kruskal-Wallis H test with Dunn's post-hoc z-tests, for ordinal outputs such as the Promis-29 raw scores.
+
+Each output is sorted once per dataset: RankEngine caches, for every patient, the index of its tie block among the
+sorted non-nan values of that output. For a given prefix the midranks of the pooled sample are then a cumulative sum
+over tie blocks, weighted by how many of the selected categories each patient falls in, and the group rank sums are
+one matrix product with the category masks. This reproduces scipy.stats.kruskal on the concatenated group arrays
+(including overlapping one-hot categories) without re-ranking per prefix.
+"""
+__author__ = "Arjit M; amisra2@illinois.edu"
+__version__ = "Feb 2 2024"
+
+import numpy as np
+
+DUNN_ADJUST = ["bonferroni", "holm", "none"]
+
+
+class RankEngine:
+    """
+    Tie structure of every output of one patient frame, computed on first use and cached. A sweep holds one engine
+    per frame and passes it to every do_anova call on that frame, so ranks are computed once per output across all
+    prefixes.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._ties = dict()
+
+    def ties(self, output):
+        """
+        Tie block index of each patient (-1 where the output is nan) and the number of tie blocks.
+        """
+        if output not in self._ties:
+            y = self.data[output].to_numpy(dtype=float)
+            ok = ~np.isnan(y)
+            tie_id = np.full(len(y), -1)
+            uniq, tie_id[ok] = np.unique(y[ok], return_inverse=True)
+            self._ties[output] = (tie_id, len(uniq))
+        return self._ties.get(output)
+
+    def rank_sums(self, output, masks):
+        """
+        Group sizes, group rank sums and the tie term sum(t^3 - t) of the pooled sample of the masked groups.
+        """
+        tie_id, n_ties = self.ties(output)
+        valid = tie_id >= 0
+        m = masks[valid].astype(float)
+        tid = tie_id[valid]
+
+        # A patient in several (one-hot) categories appears once per category in the pooled sample.
+        w = m.sum(axis=1)
+        W = np.bincount(tid, weights=w, minlength=n_ties)
+        midrank = np.cumsum(W) - W + (W + 1) / 2
+
+        n = m.sum(axis=0)
+        R = midrank[tid] @ m
+        return n, R, np.sum(W ** 3 - W)
+
+    def kruskal_dunn(self, output, masks, adjust="bonferroni"):
+        """
+        Kruskal-Wallis H and p-value, Dunn z-scores and adjusted pairwise p-values for categories given as boolean
+        columns of masks.
+        """
+        from scipy import stats
+
+        if adjust not in DUNN_ADJUST:
+            raise ValueError("Unknown adjustment {0}. Expected one of {1}".format(adjust, DUNN_ADJUST))
+
+        n, R, tie_sum = self.rank_sums(output, masks)
+        k = len(n)
+        N = np.sum(n)
+
+        C = 1 - tie_sum / (N ** 3 - N)
+        H = (12 / (N * (N + 1)) * np.sum(R ** 2 / n) - 3 * (N + 1)) / C
+        p = stats.chi2.sf(H, k - 1)
+
+        r_bar = R / n
+        var = N * (N + 1) / 12 - tie_sum / (12 * (N - 1))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            Z = (r_bar[:, None] - r_bar[None, :]) / np.sqrt(var * (1 / n[:, None] + 1 / n[None, :]))
+        np.fill_diagonal(Z, 0)
+        P = 2 * stats.norm.sf(np.abs(Z))
+
+        i, j = np.triu_indices(k, 1)
+        P[i, j] = P[j, i] = adjust_pvalues(P[i, j], adjust)
+        np.fill_diagonal(P, 1)
+        return H, p, Z, P, r_bar
+
+
+def adjust_pvalues(p, adjust="bonferroni"):
+    p = np.asarray(p, dtype=float)
+    m = len(p)
+    if adjust == "bonferroni":
+        return np.minimum(p * m, 1)
+    if adjust == "holm":
+        order = np.argsort(p)
+        adj = np.maximum.accumulate(p[order] * (m - np.arange(m)))
+        out = np.empty(m)
+        out[order] = np.minimum(adj, 1)
+        return out
+    return p
@@ -0,0 +1,74 @@
+"""
+Single-pass figure reports. Every figure do_anova draws for a result directory is written into one multi-page PDF
+(default), an SVG set, or a JPEG/PNG set at a reduced dpi, instead of one 600 dpi JPEG per figure.
+"""
+__author__ = "Arjit M; amisra2@illinois.edu"
+__version__ = "Feb 2 2024"
+
+import os
+
+REPORT_FORMATS = ["pdf", "svg", "jpg", "png"]
+
+# Fonts are embedded once per PDF as TrueType (instead of a Type 3 subset per page) and SVG text is kept as text,
+# so a page adds only its own paths.
+REPORT_RC = {
+    "pdf.fonttype": 42,
+    "svg.fonttype": "none",
+    "path.simplify": True,
+}
+
+
+class FigureReport:
+    """
+    Sink for the figures of one result directory. fmt = "pdf" writes result_dir/report.pdf with one page per figure
+    and an index of pages; "svg", "jpg" and "png" keep the usual result_dir/var_head[/output] layout at the given dpi.
+    """
+
+    def __init__(self, result_dir, fmt="pdf", dpi=150):
+        if fmt not in REPORT_FORMATS:
+            raise ValueError("Unknown report format {0}. Expected one of {1}".format(fmt, REPORT_FORMATS))
+
+        self.result_dir = result_dir
+        self.fmt = fmt
+        self.dpi = dpi
+        self.pages = []
+        self._pdf = None
+
+        os.makedirs(result_dir, exist_ok=True)
+        if fmt == "pdf":
+            from matplotlib.backends.backend_pdf import PdfPages
+
+            self._pdf = PdfPages("{0}/report.pdf".format(result_dir), metadata={"Title": result_dir})
+
+    def add(self, fig, name):
+        """
+        Write fig as page/file `name` (e.g. "tumor_loc" or "tumor_loc/p29_pf_raw") and close it.
+        """
+        import matplotlib as mpl
+        from matplotlib import pyplot as plt
+
+        with mpl.rc_context(REPORT_RC):
+            if self._pdf is not None:
+                self._pdf.savefig(fig)
+            else:
+                fig.savefig("{0}/{1}.{2}".format(self.result_dir, name, self.fmt), dpi=self.dpi)
+        self.pages.append(name)
+        plt.close(fig)
+
+    def close(self):
+        if self._pdf is not None:
+            import matplotlib as mpl
+
+            # Fonts are written when the document is finalised.
+            with mpl.rc_context(REPORT_RC):
+                self._pdf.close()
+            with open("{0}/report_index.tsv".format(self.result_dir), 'w') as outfile:
+                for page, name in enumerate(self.pages, 1):
+                    outfile.write("{0}\t{1}\n".format(page, name))
+            self._pdf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,132 @@
+"""
+Robustness of the ANOVA sweep to min_size and p_thresh, from one StatsCube instead of one full rerun per setting.
+
+The per-category counts of patients with a complete output set are computed once when the cube is built. Sorted, they
+give the category set of every min_size directly: raising min_size only ever drops the categories with the smallest
+counts, so the grid collapses to the few distinct category sets that actually occur. The ANOVA and Tukey HSD of each
+distinct set are computed once from the cube's group statistics and re-thresholded for every p_thresh.
+
+    python npa_sensitivity.py npadata_race.csv --min-size 5 10 15 20 30 --p-thresh 0.01 0.05 0.1
+    python npa_sensitivity.py pooled.npz
+
+Writes <out>/sensitivity.tsv: one row per output set, prefix, output, min_size and p_thresh, with the number of
+categories, the omnibus test, its significance and the letter groups, and which of these differ from the do_anova
+defaults (min_size=15, p_thresh=0.05).
+"""
+__author__ = "Arjit M; amisra2@illinois.edu"
+__version__ = "Feb 2 2024"
+
+import os
+import argparse
+
+import numpy as np
+
+from npa_consts import PREFIX_TO_LABELS, OUTPUT_SETS
+from npa_helpers import getGroupLabels
+from npa_cube import GroupCube, StatsCube
+
+DEFAULT_MIN_SIZE = 15
+DEFAULT_P_THRESH = 0.05
+
+
+def category_sets(complete, min_sizes):
+    """
+    Distinct category sets over a min_size grid. complete: count of complete patients per category. Returns
+    {category indices (in category order): [min_size, ...]}.
+    """
+    order = np.argsort(complete, kind="stable")
+    dropped = np.searchsorted(complete[order], min_sizes, side="right")
+    sets = dict()
+    for m, d in zip(min_sizes, dropped):
+        sets.setdefault(tuple(np.sort(order[d:])), []).append(m)
+    return sets
+
+
+def sensitivity_rows(cube, var_head, set_name, min_sizes, p_threshes, labels=None):
+    """
+    Sensitivity rows of one prefix and output set of a StatsCube:
+    (output, min_size, p_thresh, categories, f, p, significant, groups).
+    """
+    p = cube.prefixes[var_head]
+    outputs = cube.output_sets[set_name]
+    cols = [cube.outputs.index(o) for o in outputs]
+    complete = p["complete"][:, list(cube.output_sets).index(set_name)]
+
+    labeller = labels if labels is not None else PREFIX_TO_LABELS.get(var_head, dict())
+    cat_labs = [str(labeller.get(int(k), int(k))) for k in p["keys"]]
+    p_max = max(p_threshes)
+
+    rows = []
+    for cats, sizes in category_sets(complete, min_sizes).items():
+        cats = list(cats)
+        k = len(cats)
+        if k < 2:
+            for output in outputs:
+                rows += [(output, m, t, k, np.nan, np.nan, False, "") for m in sizes for t in p_threshes]
+            continue
+
+        sub = GroupCube(outputs, *[p[f][np.ix_(cats, cols)] for f in ["n", "s", "ss"]])
+        a = sub.anova()
+        for o, output in enumerate(outputs):
+            f_o, p_o = a["f"][o], a["p"][o]
+            # One Tukey HSD per category set and output serves every p_thresh of the grid.
+            Pij = sub.tukey(o)[0] if p_o < p_max else None
+            for t in p_threshes:
+                diff_str = getGroupLabels(Pij < t) if p_o < t else ['a' for _ in cats]
+                groups = "; ".join("{0} ({1})".format(cat_labs[c], d) for c, d in zip(cats, diff_str))
+                rows += [(output, m, t, k, f_o, p_o, bool(p_o < t), groups) for m in sizes]
+
+    order = {o: i for i, o in enumerate(outputs)}
+    return sorted(rows, key=lambda r: (order[r[0]], r[1], r[2]))
+
+
+def sweep_sensitivity(cube, min_sizes, p_threshes, labels=None):
+    """
+    Sensitivity rows of every output set and prefix of a StatsCube, each marked with what differs from the row at
+    the do_anova defaults: rows of (set, prefix, output, min_size, p_thresh, categories, f, p, significant, groups,
+    changed).
+    """
+    labels = labels or dict()
+    min_sizes = sorted(set(min_sizes) | {DEFAULT_MIN_SIZE})
+    p_threshes = sorted(set(p_threshes) | {DEFAULT_P_THRESH})
+
+    table = []
+    for set_name in cube.output_sets:
+        for var_head in cube.prefixes:
+            rows = sensitivity_rows(cube, var_head, set_name, min_sizes, p_threshes, labels.get(var_head))
+            ref = {r[0]: r for r in rows if r[1] == DEFAULT_MIN_SIZE and r[2] == DEFAULT_P_THRESH}
+            for r in rows:
+                b = ref[r[0]]
+                changed = [name for name, i in [("categories", 3), ("significance", 6), ("groups", 7)] if r[i] != b[i]]
+                table.append((set_name, var_head) + r + (",".join(changed),))
+    return table
+
+
+def write_sensitivity(table, result_dir="results_sensitivity"):
+    os.makedirs(result_dir, exist_ok=True)
+    with open("{0}/sensitivity.tsv".format(result_dir), 'w') as outfile:
+        outfile.write("\t".join(["set", "prefix", "output", "min_size", "p_thresh", "categories", "f", "p",
+                                 "significant", "groups", "changed"]) + "\n")
+        for set_name, var_head, output, m, t, k, f, p, sig, groups, changed in table:
+            outfile.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}\t{8}\t{9}\t{10}\n".format(
+                set_name, var_head, output, m, t, k, round(f, 2), round(p, 4), sig, groups, changed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="min_size / p_thresh sensitivity of the ANOVA sweep.")
+    parser.add_argument("data", nargs="?", default="npadata_race.csv",
+                        help="Site export (csv) or a StatsCube built by npa_cube.py (npz).")
+    parser.add_argument("--min-size", type=int, nargs="+", default=[5, 10, 15, 20, 30])
+    parser.add_argument("--p-thresh", type=float, nargs="+", default=[0.01, 0.05, 0.1])
+    parser.add_argument("--out", default="results_sensitivity")
+    args = parser.parse_args()
+
+    if args.data.endswith(".npz"):
+        cube, prefix_labels = StatsCube.load(args.data), None
+    else:
+        from npa_new import load_data, prepare_adf
+
+        adf, prefix_labels, prefix_one_hot, _ = prepare_adf(load_data(args.data))
+        cube = StatsCube.build(adf, OUTPUT_SETS, prefix_one_hot)
+
+    write_sensitivity(sweep_sensitivity(cube, args.min_size, args.p_thresh, prefix_labels), args.out)
@@ -0,0 +1,212 @@
+"""
+Patient data published once in shared memory for worker processes. The parent copies the numeric columns of the
+patient frame and the membership masks of every category of every prefix into multiprocessing.shared_memory blocks;
+workers are handed only a small descriptor (block names, shapes, column names) and attach read-only NumPy views of
+the same pages, so the frame is never pickled into a worker and its memory is shared rather than duplicated.
+
+    python npa_shared.py npadata_race.csv -j 4
+
+runs the stats-only ANOVA sweep of OUTPUT_SETS this way and writes shared_memory_report.tsv with the resident size
+of every worker (total, private and shared pages, from /proc where available).
+"""
+__author__ = "Arjit M; amisra2@illinois.edu"
+__version__ = "Feb 2 2024"
+
+import os
+import re
+import pickle
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from npa_consts import OUTPUT_SETS
+from npa_nonparam import RankEngine
+
+_WORKER = dict()
+
+
+class SharedDataset:
+    """
+    Numeric patient matrix, its index and the category masks of every prefix in shared memory. The publishing
+    process owns the blocks and unlinks them on close(); attached copies only unmap them.
+    """
+
+    def __init__(self, desc, blocks, owner=False):
+        self.desc = desc
+        self.blocks = blocks
+        self.owner = owner
+        self.values = self._view("values")
+        self.masks = self._view("masks")
+        self.index = self._view("index") if "index" in blocks else desc["index"]
+
+    def _view(self, name):
+        shape, dtype = self.desc[name]
+        arr = np.ndarray(shape, dtype=dtype, buffer=self.blocks[name].buf)
+        arr.flags.writeable = False
+        return arr
+
+    @classmethod
+    def publish(cls, adf, prefix_one_hot, columns=None):
+        """
+        Copy the numeric columns (or the given columns) of adf and the masks of every category of the prefixes of
+        prefix_one_hot into new shared memory blocks.
+        """
+        if columns is None:
+            columns = [c for c in adf.columns if pd.api.types.is_numeric_dtype(adf[c])]
+
+        keys, cols = dict(), []
+        for var_head, one_hot in prefix_one_hot.items():
+            if one_hot:
+                cats = [c for c in adf.columns if re.match("{0}_*\\d+".format(var_head), c)]
+                cols += [(adf[C] == 1).to_numpy() for C in cats]
+            elif var_head in adf.columns:
+                x = adf[var_head].to_numpy(dtype=float)
+                cats = list(np.unique(x[~np.isnan(x)]))
+                cols += [x == C for C in cats]
+            else:
+                continue
+            keys[var_head] = (len(cols) - len(cats), cats)
+
+        arrays = {
+            "values": adf[columns].to_numpy(dtype=float),
+            "masks": np.column_stack(cols) if cols else np.zeros((len(adf), 0), dtype=bool),
+        }
+        desc = dict(columns=list(columns), index_name=adf.index.name, keys=keys, names=dict())
+
+        # Numeric patient ids are shared too; other ids cannot live in a raw buffer and travel with the descriptor.
+        if adf.index.dtype.kind in "biuf":
+            arrays["index"] = adf.index.to_numpy()
+        else:
+            desc["index"] = list(adf.index)
+        blocks = dict()
+        for name, arr in arrays.items():
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            blocks[name] = shm
+            desc[name] = (arr.shape, arr.dtype.str)
+            desc["names"][name] = shm.name
+        return cls(desc, blocks, owner=True)
+
+    @classmethod
+    def attach(cls, desc):
+        return cls(desc, {name: shared_memory.SharedMemory(name=shm) for name, shm in desc["names"].items()})
+
+    def frame(self):
+        """
+        DataFrame over the shared values, without copying them.
+        """
+        index = pd.Index(self.index, name=self.desc["index_name"])
+        return pd.DataFrame(self.values, index=index, columns=self.desc["columns"], copy=False)
+
+    def category_masks(self, var_head, categories):
+        """
+        Shared masks of the given categories of var_head, as category_masks() would compute them.
+        """
+        start, cats = self.desc["keys"][var_head]
+        return self.masks[:, [start + cats.index(C) for C in categories]]
+
+    def prefix_masks(self, var_head):
+        """
+        Every category of var_head and the shared (patients, categories) block of their masks.
+        """
+        start, cats = self.desc["keys"][var_head]
+        return cats, self.masks[:, start:start + len(cats)]
+
+    def nbytes(self):
+        return sum(shm.size for shm in self.blocks.values())
+
+    def close(self):
+        # Views must be dropped before the blocks can be unmapped.
+        self.values = self.masks = self.index = None
+        for shm in self.blocks.values():
+            shm.close()
+            if self.owner:
+                shm.unlink()
+
+
+def memory_usage():
+    """
+    Resident set size of this process in bytes: total, private (anonymous) and shared-memory pages. Falls back to the
+    peak resident size where /proc is not available.
+    """
+    try:
+        with open("/proc/self/status") as infile:
+            status = {ln.split(":")[0]: ln.split()[1:] for ln in infile}
+        kb = lambda k: int(status[k][0]) * 1024 if k in status else np.nan
+        return dict(rss=kb("VmRSS"), anon=kb("RssAnon"), shmem=kb("RssShmem"))
+    except OSError:
+        import resource
+
+        return dict(rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, anon=np.nan, shmem=np.nan)
+
+
+def _init_worker(desc, prefix_labels, prefix_one_hot, kwargs):
+    dataset = SharedDataset.attach(desc)
+    data = dataset.frame()
+    _WORKER.update(dataset=dataset, data=data, ranks=RankEngine(data), labels=prefix_labels, one_hot=prefix_one_hot,
+                   kwargs=kwargs)
+
+
+def _run_shared(result_dir, outputs, var_head):
+    from npa_new import do_anova, find_categories
+
+    w = _WORKER
+    one_hot = w["one_hot"].get(var_head)
+    kwargs = w["kwargs"]
+    categories = find_categories(var_head, outputs, w["data"], one_hot, kwargs.get("min_size", 15))
+    masks = w["dataset"].category_masks(var_head, categories) if len(categories) >= 2 else None
+    cube = do_anova(var_head, outputs, [100] * len(outputs), w["data"], one_hot, result_dir=result_dir,
+                    plot_mode=False, labels=w["labels"].get(var_head), categories=categories, masks=masks,
+                    ranks=w["ranks"], **kwargs)
+    return result_dir, var_head, cube, os.getpid(), memory_usage()
+
+
+def sweep_shared(adf, prefix_labels, prefix_one_hot, output_sets=OUTPUT_SETS, workers=None, **kwargs):
+    """
+    Stats-only do_anova of every output set and prefix on worker processes attached to one shared copy of adf.
+    kwargs are passed to do_anova (min_size, p_thresh, method, ...). Returns the cubes keyed by (result_dir, prefix)
+    and the last memory reading of each worker, keyed by pid.
+    """
+    dataset = SharedDataset.publish(adf, prefix_one_hot)
+    tasks = [(d, list(outputs), var) for d, outputs in output_sets.items() for var in prefix_labels
+             if var in dataset.desc["keys"]]
+    cubes, memory = dict(), dict()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(dataset.desc, prefix_labels, prefix_one_hot, kwargs)) as pool:
+            for result_dir, var_head, cube, pid, usage in pool.map(_run_shared, *zip(*tasks)):
+                cubes[(result_dir, var_head)] = cube
+                memory[pid] = usage
+    finally:
+        report = dict(shared=dataset.nbytes(), descriptor=len(pickle.dumps(dataset.desc)),
+                      frame=int(adf.memory_usage(index=True, deep=True).sum()))
+        dataset.close()
+    return cubes, memory, report
+
+
+def write_memory_report(memory, report, path="shared_memory_report.tsv"):
+    mb = lambda x: "" if np.isnan(x) else str(round(x / 2 ** 20, 1))
+    with open(path, 'w') as outfile:
+        outfile.write("shared blocks (MB)\t{0}\n".format(mb(report["shared"])))
+        outfile.write("descriptor sent per worker (MB)\t{0}\n".format(mb(report["descriptor"])))
+        outfile.write("patient frame, copied per worker if pickled (MB)\t{0}\n\n".format(mb(report["frame"])))
+        outfile.write("\t".join(["worker pid", "rss (MB)", "private (MB)", "shared memory (MB)"]) + "\n")
+        for pid, usage in sorted(memory.items()):
+            outfile.write("\t".join([str(pid), mb(usage["rss"]), mb(usage["anon"]), mb(usage["shmem"])]) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stats-only ANOVA sweep on workers sharing one copy of the data.")
+    parser.add_argument("data", nargs="?", default="npadata_race.csv")
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("--report", default="shared_memory_report.tsv")
+    args = parser.parse_args()
+
+    from npa_new import load_data, prepare_adf
+
+    adf, prefix_labels, prefix_one_hot, _ = prepare_adf(load_data(args.data))
+    _, memory, report = sweep_shared(adf, prefix_labels, prefix_one_hot, workers=args.workers)
+    write_memory_report(memory, report, args.report)
@@ -0,0 +1,256 @@
+"""
+Declarative analysis runs. A JSON (or YAML, if PyYAML is installed) spec lists the data, prefixes and analyses; it is
+compiled into a DAG in which every step is keyed by what it computes, so steps common to several analyses are created
+once:
+
+    load      one per data file: read + derived scores
+    adf       one per data file: per-patient frame, tumor metrics, prefix labels
+    ranks     one per data file: RankEngine of the frame, ranking each output once for Kruskal-Wallis
+    classes   one per (prefix, outputs, min_size): category discovery and masks
+    cube      one per (prefix, outputs, min_size): group statistics
+    analysis  one per (result_dir, prefix, method, outputs, min_size, p_thresh[, covariates]): do_anova / do_ancova
+              report. Analyses that differ but would write the same report files are rejected.
+
+Independent nodes run concurrently on a thread pool; nodes that draw with pyplot are serialised.
+
+    python npa_spec.py npa_spec.json -j 8
+
+See npa_spec.json for the spec equivalent to the default npa_new sweep.
+"""
+__author__ = "Arjit M; amisra2@illinois.edu"
+__version__ = "Feb 2 2024"
+
+import json
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from npa_consts import P29_COMPONENTS, OUTPUT_SETS, ANCOVA_COVARIATES, PREFIX_IS_ONE_HOT, TUMOR_METRICS
+from npa_new import load_data, prepare_adf, find_categories, category_masks, do_anova, METHODS
+from npa_cube import GroupCube
+from npa_nonparam import RankEngine
+from npa_report import FigureReport
+
+SPEC_DEFAULTS = {
+    "min_size": 15,
+    "p_thresh": 0.05,
+    "method": "anova",
+    "plot": False,
+    "report": None,
+    "dpi": 150,
+    "out_min": None,
+    "covariates": ANCOVA_COVARIATES,
+}
+
+_PLOT_LOCK = threading.Lock()
+
+
+class Dag:
+    """
+    Nodes keyed by hashable tuples. add() of an existing key returns it unchanged, which is what deduplicates steps
+    shared between analyses. A node's function receives the results of its dependencies in order.
+    """
+
+    def __init__(self):
+        self.nodes = dict()
+
+    def add(self, key, func, deps=(), serial=False):
+        if key not in self.nodes:
+            self.nodes[key] = (func, tuple(deps), serial)
+        return key
+
+    def run(self, workers=None, done=None):
+        """
+        Run every node whose result is not already given in done. Returns the results of all nodes by key.
+        """
+        results = dict(done or dict())
+        waiting = {k: set(deps) - set(results) for k, (_, deps, _) in self.nodes.items() if k not in results}
+        dependents = {k: [] for k in self.nodes}
+        for k in waiting:
+            for d in self.nodes[k][1]:
+                dependents[d].append(k)
+
+        def call(key):
+            func, deps, serial = self.nodes[key]
+            args = [results[d] for d in deps]
+            if serial:
+                with _PLOT_LOCK:
+                    return func(*args)
+            return func(*args)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            running = {pool.submit(call, k): k for k, deps in waiting.items() if not deps}
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    key = running.pop(fut)
+                    results[key] = fut.result()
+                    for dep in dependents[key]:
+                        waiting[dep].discard(key)
+                        if not waiting[dep]:
+                            running[pool.submit(call, dep)] = dep
+        return results
+
+
+def load_spec(path):
+    with open(path) as infile:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("PyYAML is required for YAML specs; use a JSON spec instead.")
+            return yaml.safe_load(infile)
+        return json.load(infile)
+
+
+def resolve_outputs(outputs):
+    """
+    Outputs (or their plot limits) may be given as a list or as the name of an OUTPUT_SETS / P29_COMPONENTS entry.
+    """
+    if isinstance(outputs, str):
+        return list(OUTPUT_SETS.get(outputs) or P29_COMPONENTS[outputs])
+    return None if outputs is None else list(outputs)
+
+
+def _load(path):
+    return load_data(path)
+
+
+def _adf(expanded, tumor_bins, edges):
+    def step(df):
+        prepared = prepare_adf(df, tumor_bins, edges)
+        if expanded:
+            prepared[0].to_csv(expanded)
+        return prepared
+    return step
+
+
+def _classes(var_head, outputs, min_size):
+    def step(prepared):
+        adf, _, prefix_one_hot, _ = prepared
+        one_hot = prefix_one_hot.get(var_head)
+        categories = find_categories(var_head, outputs, adf, one_hot, min_size)
+        return categories, category_masks(var_head, categories, adf, one_hot)
+    return step
+
+
+def _cube(var_head, outputs):
+    def step(prepared, classes):
+        categories, masks = classes
+        if len(categories) < 2:
+            return None
+        return GroupCube.from_masks(prepared[0][list(outputs)].to_numpy(dtype=float), masks, outputs)
+    return step
+
+
+def _ranks(prepared):
+    return RankEngine(prepared[0])
+
+
+def _analysis(var_head, a, report):
+    def step(prepared, classes, cube, ranks):
+        adf, prefix_labels, prefix_one_hot, _ = prepared
+        if a["method"] == "ancova":
+            from npa_ancova import do_ancova
+
+            return do_ancova(var_head, a["outputs"], adf, prefix_one_hot.get(var_head), a["covariates"], a["min_size"],
+                             a["p_thresh"], a["result_dir"], prefix_labels.get(var_head))
+        categories, masks = classes
+        return do_anova(var_head, a["outputs"], a["out_max"], adf, prefix_one_hot.get(var_head), a["min_size"],
+                        a["p_thresh"], a["result_dir"], a["out_min"], a["plot"], report,
+                        prefix_labels.get(var_head), a["method"], categories=categories, masks=masks, cube=cube,
+                        ranks=ranks)
+    return step
+
+
+def resolve_analyses(spec):
+    """
+    The analyses of a spec with defaults applied, outputs and plot limits resolved to lists and the prefixes of each
+    listed.
+    """
+    defaults = dict(SPEC_DEFAULTS, **spec.get("defaults", dict()))
+
+    # "all" is the prefixes of the default sweep; the DAG is compiled before any data is read.
+    prefixes = spec.get("prefixes", "all")
+    if prefixes == "all":
+        prefixes = list(PREFIX_IS_ONE_HOT)
+        if spec.get("tumor_bins", True):
+            prefixes += [m + "_q" for m in TUMOR_METRICS]
+
+    analyses = []
+    for analysis in spec["analyses"]:
+        a = dict(defaults, **analysis)
+        a["outputs"] = resolve_outputs(a["outputs"])
+        a["out_max"] = resolve_outputs(a.get("out_max"))
+        if a["out_max"] is None:
+            a["out_max"] = [100] * len(a["outputs"])
+        if a["method"] not in list(METHODS) + ["ancova"]:
+            raise ValueError("Unknown method {0} in analysis {1}".format(a["method"], a["result_dir"]))
+        a["prefixes"] = list(a.get("prefixes", prefixes))
+        analyses.append(a)
+    return analyses
+
+
+def compile_spec(spec, edges=None):
+    """
+    DAG of a spec and the figure reports it writes to. Returns (dag, reports). edges: tumor bin edges to reuse, see
+    prepare_adf.
+    """
+    dag = Dag()
+    reports = dict()
+    data = spec.get("data", "npadata_race.csv")
+
+    load = dag.add(("load", data), lambda: _load(data))
+    prepared = dag.add(("adf", data), _adf(spec.get("expanded"), spec.get("tumor_bins", True), edges), [load])
+    ranks = dag.add(("ranks", data), _ranks, [prepared])
+
+    written = dict()
+    for a in resolve_analyses(spec):
+        report = None
+        if a["plot"] and a["report"]:
+            # One report per result_dir: opening a second would truncate the first's file.
+            if a["result_dir"] not in reports:
+                reports[a["result_dir"]] = FigureReport(a["result_dir"], a["report"], a["dpi"])
+            report = reports[a["result_dir"]]
+
+        outs = tuple(a["outputs"])
+        covariates = tuple(a["covariates"]) if a["method"] == "ancova" else None
+        for var_head in a["prefixes"]:
+            key = ("analysis", a["result_dir"], var_head, a["method"], outs, a["min_size"], a["p_thresh"], covariates)
+            # Reports are named by result_dir, prefix and method only.
+            if written.setdefault((a["result_dir"], var_head, a["method"]), key) != key:
+                raise ValueError("Two {0} analyses of {1} in {2} differ in outputs, min_size, p_thresh or covariates "
+                                 "and would overwrite each other's reports.".format(a["method"], var_head,
+                                                                                    a["result_dir"]))
+            classes = dag.add(("classes", data, var_head, outs, a["min_size"]),
+                              _classes(var_head, outs, a["min_size"]), [prepared])
+            cube = dag.add(("cube", data, var_head, outs, a["min_size"]), _cube(var_head, outs), [prepared, classes])
+            dag.add(key, _analysis(var_head, a, report), [prepared, classes, cube, ranks], serial=bool(a["plot"]))
+    return dag, reports
+
+
+def run_spec(spec, workers=None, done=None, edges=None, compiled=None):
+    """
+    Run a spec, or the (dag, reports) compile_spec already returned for it, closing its reports.
+    """
+    dag, reports = compiled if compiled is not None else compile_spec(spec, edges)
+    try:
+        return dag.run(workers, done)
+    finally:
+        for report in reports.values():
+            report.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the analyses declared in a JSON/YAML spec.")
+    parser.add_argument("spec")
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    spec = load_spec(args.spec)
+    dag, reports = compile_spec(spec)
+    kinds = dict()
+    for key in dag.nodes:
+        kinds[key[0]] = kinds.get(key[0], 0) + 1
+    print("DAG: " + ", ".join("{0} {1}".format(n, k) for k, n in kinds.items()))
+    run_spec(spec, args.workers, compiled=(dag, reports))
@@ -0,0 +1,123 @@
+"""
+The ANOVA sweep repeated within every level of a stratifier (e.g. metastatic, resection_type):
+
+    python npa_new.py --stratify-by resection_type -j 4
+
+The patient index is split into strata once. The patient frame and the masks of every category of every prefix are
+published once in shared memory (npa_shared); for each stratum, prefix and output set a worker takes the rows of the
+shared masks that fall in the stratum and keeps the categories with more than min_size complete patients there, as
+find_categories would on the stratum alone, without rebuilding any mask.
+
+Each stratum's do_anova reports go to results_by_<stratifier>/<stratifier>=<level>/<output set>/, and all of them are
+stacked in one combined table, results_by_<stratifier>/strata_<suffix>.tsv.
+"""
+__author__ = "Arjit M; amisra2@illinois.edu"
+__version__ = "Feb 2 2024"
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from npa_consts import OUTPUT_SETS, OUTPUT_LIMITS, PREFIX_TO_LABELS
+from npa_nonparam import RankEngine
+from npa_shared import SharedDataset
+
+_WORKER = dict()
+
+
+def split_strata(data, stratifier):
+    """
+    {level: row positions} of every non-nan level of the stratifier column.
+    """
+    if stratifier not in data.columns:
+        raise ValueError("Unknown stratifier {0}; expected an integer-coded column such as metastatic.".format(
+            stratifier))
+    x = data[stratifier].to_numpy(dtype=float)
+    return {lev: np.flatnonzero(x == lev) for lev in np.unique(x[~np.isnan(x)])}
+
+
+def stratum_name(stratifier, level):
+    return "{0}={1}".format(stratifier, int(level))
+
+
+def _init_worker(desc, strata, prefix_labels, prefix_one_hot, kwargs):
+    dataset = SharedDataset.attach(desc)
+    _WORKER.update(dataset=dataset, data=dataset.frame(), strata=strata, labels=prefix_labels,
+                   one_hot=prefix_one_hot, kwargs=kwargs, frames=dict())
+
+
+def _run_stratum(result_dir, outputs, out_max, out_min, var_head, level):
+    from npa_new import do_anova
+
+    w = _WORKER
+    rows = w["strata"][level]
+    dataset = w["dataset"]
+    kwargs = dict(w["kwargs"])
+    root = kwargs.pop("root")
+    min_size = kwargs.get("min_size", 15)
+
+    # Stratum frames and their ranks are made once per worker and reused by every prefix and output set.
+    if level not in w["frames"]:
+        frame = w["data"].iloc[rows]
+        w["frames"][level] = (frame, RankEngine(frame))
+    data, ranks = w["frames"][level]
+
+    cols = [dataset.desc["columns"].index(o) for o in outputs]
+    complete = ~np.isnan(dataset.values[np.ix_(rows, cols)]).any(axis=1)
+    cats, block = dataset.prefix_masks(var_head)
+    masks = block[rows]
+    keep = np.flatnonzero((masks & complete[:, None]).sum(axis=0) > min_size)
+
+    out_dir = os.path.join(root, stratum_name(kwargs.pop("stratifier"), level), result_dir)
+    do_anova(var_head, outputs, out_max, data, w["one_hot"].get(var_head), result_dir=out_dir, out_min=out_min,
+             labels=w["labels"].get(var_head), categories=[cats[i] for i in keep], masks=masks[:, keep], ranks=ranks,
+             **kwargs)
+    return result_dir, var_head, level, out_dir
+
+
+def combine_strata(runs, stratifier, root, suffix):
+    """
+    Stack the do_anova TSVs of every output set, prefix and stratum into one table, each block led by its header
+    row of category labels.
+    """
+    labels = PREFIX_TO_LABELS.get(stratifier, dict())
+    with open(os.path.join(root, "strata_{0}.tsv".format(suffix)), 'w') as outfile:
+        for result_dir, var_head, level, out_dir in runs:
+            path = os.path.join(out_dir, "{0}_{1}.tsv".format(var_head, suffix))
+            if not os.path.exists(path):
+                continue
+            stratum = "{0}={1}".format(stratifier, labels.get(int(level), int(level)))
+            with open(path) as infile:
+                for ln in infile:
+                    outfile.write("\t".join([result_dir, var_head, stratum]) + "\t" + ln)
+
+
+def sweep_strata(adf, prefix_labels, prefix_one_hot, stratifier, output_sets=OUTPUT_SETS, workers=None,
+                 root=None, method="anova", **kwargs):
+    """
+    do_anova of every output set and prefix within every stratum, on worker processes sharing one copy of the data.
+    kwargs are passed to do_anova. Returns the combined table's path.
+    """
+    from npa_new import METHODS
+
+    root = root or "results_by_{0}".format(stratifier)
+    strata = split_strata(adf, stratifier)
+    dataset = SharedDataset.publish(adf, prefix_one_hot)
+
+    # The stratifier is constant within a stratum.
+    prefixes = [v for v in prefix_labels if v in dataset.desc["keys"] and v != stratifier]
+    tasks = [(d, list(outputs)) + tuple(OUTPUT_LIMITS.get(d, ([100] * len(outputs), None))) + (v, lev)
+             for d, outputs in output_sets.items() for v in prefixes for lev in strata]
+
+    kwargs = dict(kwargs, root=root, stratifier=stratifier, method=method)
+    kwargs.setdefault("plot_mode", False)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(dataset.desc, strata, prefix_labels, prefix_one_hot, kwargs)) as pool:
+            runs = list(pool.map(_run_stratum, *zip(*tasks)))
+    finally:
+        dataset.close()
+
+    combine_strata(runs, stratifier, root, METHODS[method][4])
+    return os.path.join(root, "strata_{0}.tsv".format(METHODS[method][4]))
@@ -0,0 +1,86 @@
+"""
+Descriptive statistics of every category x output of one prefix, computed together rather than per ragged group
+array. N and mean are those of the prefix's GroupCube; a GroupSummary adds the standard deviation, quantiles and the
+order of the categories by mean. do_anova writes its text/TSV summaries and the {var}_summary.tsv table from one
+GroupSummary, and make_ind_plots takes its size order from it.
+
+The (patient, category) pairs of the masks are sorted by category once, keeping patients in frame order, so every
+category is a contiguous segment; per output, squared deviations are summed per category and quantiles are read off
+the segments after sorting values within them.
+"""
+__author__ = "Arjit M; amisra2@illinois.edu"
+__version__ = "Feb 2 2024"
+
+import numpy as np
+
+SUMMARY_QUANTILES = (0.25, 0.5, 0.75)
+
+
+class GroupSummary:
+    """
+    Arrays n, mean (the cube's), std (ddof=0, as np.std) of shape (categories, outputs), quantiles of shape
+    (len(q), categories, outputs) and order, the categories of each output by decreasing mean.
+    """
+
+    def __init__(self, cube, q, std, quantiles):
+        self.outputs = cube.outputs
+        self.q = tuple(q)
+        self.n = cube.n
+        self.mean = cube.mean
+        self.std = std
+        self.quantiles = quantiles
+        self.order = np.argsort(-self.mean, axis=0, kind="stable")
+
+    @classmethod
+    def from_cube(cls, cube, values, masks, q=SUMMARY_QUANTILES):
+        """
+        cube: GroupCube.from_masks(values, masks, ...); values: (patients, outputs) float with nan for missing;
+        masks: (patients, categories) bool.
+        """
+        k, m = masks.shape[1], values.shape[1]
+        pt, grp = np.nonzero(masks)
+        by_grp = np.argsort(grp, kind="stable")
+        pt, grp = pt[by_grp], grp[by_grp]
+
+        mean = cube.mean
+        std = np.full((k, m), np.nan)
+        quantiles = np.full((len(q), k, m), np.nan)
+        for o in range(m):
+            v = values[pt, o]
+            ok = ~np.isnan(v)
+            v, g = v[ok], grp[ok]
+            cnt = cube.n[:, o].astype(int)
+            has = cnt > 0
+            if not has.any():
+                continue
+
+            d = v - mean[g, o]
+            std[has, o] = np.sqrt(np.bincount(g, weights=d * d, minlength=k)[has] / cnt[has])
+
+            # Empty categories have zero-length segments, so the starts of the others delimit their segments.
+            # g is non-decreasing, so sorting by (g, v) sorts within each segment; linear interpolation as np.quantile.
+            start = (np.cumsum(cnt) - cnt)[has]
+            srt = v[np.lexsort((v, g))]
+            pos = np.multiply.outer(q, cnt[has] - 1)
+            lo = np.floor(pos).astype(int)
+            hi = np.ceil(pos).astype(int)
+            a, b = srt[start + lo], srt[start + hi]
+            quantiles[:, has, o] = a + (b - a) * (pos - lo)
+        return cls(cube, q, std, quantiles)
+
+
+def write_summary(path, summary, cat_labs):
+    """
+    TSV of N, mean, std, quantiles and rank by mean of every category of every output.
+    """
+    rank = np.empty_like(summary.order)
+    np.put_along_axis(rank, summary.order, np.arange(len(cat_labs))[:, None], axis=0)
+    with open(path, 'w') as outfile:
+        outfile.write("\t".join(["", "Group", "N", "mean", "std"] + ["q{0:g}".format(x * 100) for x in summary.q] +
+                                ["rank"]) + "\n")
+        for o, output in enumerate(summary.outputs):
+            for g, lab in enumerate(cat_labs):
+                outfile.write("\t".join([output, lab, str(int(summary.n[g, o]))] +
+                                        [str(round(x, 3)) for x in [summary.mean[g, o], summary.std[g, o]]] +
+                                        [str(round(x, 3)) for x in summary.quantiles[:, g, o]] +
+                                        [str(rank[g, o] + 1)]) + "\n")
@@ -0,0 +1,170 @@
+"""
+Baseline and follow-up symptom sets, bit-packed: one bit per symptom code, 8 codes per byte, one row per patient (or
+visit). At 1M patients and ~30 codes a side is 4 MB, and set operations between the two sides are bytewise:
+
+    new        = fup & ~bsl
+    resolved   = bsl & ~fup
+    persistent = bsl & fup
+
+Counts are popcounts of the packed rows. The placeholder codes of EXCLUDE_CODES (no symptoms found, unknown) are kept
+in the packed rows for the symptom totals and masked out of the change, co-occurrence and resolution tables.
+Co-occurrence matrices (how many patients have both symptom i and j, or i at
+baseline and j at follow-up) are products of the unpacked bits, taken over row chunks so memory stays bounded.
+
+    python npa_symptoms.py npadata_race.csv --out results_symptom_sets
+"""
+__author__ = "Arjit M; amisra2@illinois.edu"
+__version__ = "Feb 2 2024"
+
+import os
+import re
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from npa_consts import FUP_SYMPTOM_LABELS, SYMPTOM_RES, EXCLUDE_CODES, UNKNOWN_CODES
+
+SIDES = ["bsl", "fup"]
+
+# Set bits of every byte value.
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(packed):
+    """
+    Number of set bits in each row of a packed (rows, bytes) uint8 array.
+    """
+    return _POPCOUNT[packed].sum(axis=1, dtype=np.int64)
+
+
+class SymptomSets:
+    """
+    codes: symptom codes in bit order; packed: {side: (rows, bytes) uint8}; index: row labels (e.g. pt_study_id).
+    symptoms: the codes that are symptoms, i.e. not in exclude.
+    """
+
+    def __init__(self, codes, packed, index=None, exclude=EXCLUDE_CODES, unknown=UNKNOWN_CODES):
+        self.codes = list(codes)
+        self.packed = packed
+        self.index = index
+        self.symptoms = [c for c in self.codes if c not in exclude]
+        # Byte masks of the symptom bits and of the bits that record a screening outcome.
+        self._symptom_mask = np.packbits(np.isin(self.codes, self.symptoms), bitorder="little")
+        self._known_mask = np.packbits(~np.isin(self.codes, unknown), bitorder="little")
+
+    @classmethod
+    def from_frame(cls, frame):
+        """
+        Pack the <side>_symptoms___<code> checkbox columns of a visit or patient frame. Codes present on only one
+        side are zero on the other.
+        """
+        cols = {side: {int(re.match("{0}_symptoms___(\\d+)$".format(side), c).group(1)): c for c in frame.columns
+                       if re.match("{0}_symptoms___\\d+$".format(side), c)} for side in SIDES}
+        codes = sorted(set(cols["bsl"]) | set(cols["fup"]))
+        packed = dict()
+        for side in SIDES:
+            bits = np.zeros((len(frame), len(codes)), dtype=bool)
+            for b, code in enumerate(codes):
+                if code in cols[side]:
+                    bits[:, b] = frame[cols[side][code]].to_numpy() == 1
+            packed[side] = np.packbits(bits, axis=1, bitorder="little")
+        return cls(codes, packed, frame.index)
+
+    def bits(self, side, rows=slice(None)):
+        """
+        Unpacked (rows, codes) bool array of one side.
+        """
+        return np.unpackbits(self.packed[side][rows], axis=1, count=len(self.codes), bitorder="little").astype(bool)
+
+    def totals(self, side):
+        """
+        Number of symptoms of each row, nan for rows with no symptom checked (as fup_total / bsl_total).
+        """
+        n = popcount(self.packed[side]).astype(float)
+        n[n == 0] = np.nan
+        return n
+
+    def changes(self):
+        """
+        Per-row counts of new, resolved and persistent symptoms. nan where either side has nothing checked other than
+        unknown codes; a side with only "no symptoms found" checked has no symptoms.
+        """
+        recorded = (popcount(self.packed["bsl"] & self._known_mask) > 0) & \
+            (popcount(self.packed["fup"] & self._known_mask) > 0)
+        bsl, fup = self.packed["bsl"] & self._symptom_mask, self.packed["fup"] & self._symptom_mask
+        out = pd.DataFrame({
+            "symptoms_new": popcount(fup & ~bsl),
+            "symptoms_resolved": popcount(bsl & ~fup),
+            "symptoms_persistent": popcount(bsl & fup),
+        }, index=self.index, dtype=float)
+        out[~recorded] = np.nan
+        return out
+
+    def cooccurrence(self, a="bsl", b=None, chunk=1 << 16):
+        """
+        (symptoms, symptoms) counts of rows with symptom i on side a and symptom j on side b (b defaults to a).
+        """
+        b = b or a
+        k = len(self.symptoms)
+        idx = [self.codes.index(c) for c in self.symptoms]
+        C = np.zeros((k, k))
+        for start in range(0, len(self.packed[a]), chunk):
+            rows = slice(start, start + chunk)
+            A = self.bits(a, rows)[:, idx].astype(np.float32)
+            B = A if b == a else self.bits(b, rows)[:, idx].astype(np.float32)
+            C += A.T @ B
+        return C.astype(np.int64)
+
+    def resolution(self, frame, res_cols=SYMPTOM_RES):
+        """
+        Baseline symptoms against the FUP_RES resolution columns of the same rows: per mapped code, patients with the
+        symptom at baseline, how many no longer report it at follow-up, how many are recorded as resolved, and how
+        often the two agree where both are known.
+        """
+        codes = [c for c in self.symptoms if c in res_cols and res_cols[c] in frame.columns]
+        idx = [self.codes.index(c) for c in codes]
+        bsl = self.bits("bsl")[:, idx]
+        fup = self.bits("fup")[:, idx]
+        R = frame[[res_cols[c] for c in codes]].to_numpy(dtype=float)
+
+        known = bsl & ~np.isnan(R)
+        gone = bsl & ~fup
+        recorded = known & (R == 1)
+        agree = known & (gone == (R == 1))
+        return pd.DataFrame({
+            "code": codes,
+            "symptom": [FUP_SYMPTOM_LABELS.get(c, c) for c in codes],
+            "res_column": [res_cols[c] for c in codes],
+            "baseline": bsl.sum(axis=0),
+            "not_at_followup": gone.sum(axis=0),
+            "recorded_resolved": recorded.sum(axis=0),
+            "res_known": known.sum(axis=0),
+            "agreement": agree.sum(axis=0) / np.maximum(known.sum(axis=0), 1),
+        })
+
+
+def write_symptom_report(sets, frame, result_dir="results_symptom_sets"):
+    """
+    Co-occurrence matrices of each side and baseline to follow-up, per-patient change counts and the FUP_RES join.
+    """
+    os.makedirs(result_dir, exist_ok=True)
+    labels = [FUP_SYMPTOM_LABELS.get(c, c) for c in sets.symptoms]
+    for a, b in [("bsl", "bsl"), ("fup", "fup"), ("bsl", "fup")]:
+        name = a if a == b else "{0}_to_{1}".format(a, b)
+        pd.DataFrame(sets.cooccurrence(a, b), index=labels, columns=labels).to_csv(
+            "{0}/cooccurrence_{1}.tsv".format(result_dir, name), sep="\t")
+    sets.changes().to_csv("{0}/symptom_changes.tsv".format(result_dir), sep="\t")
+    sets.resolution(frame).round(4).to_csv("{0}/symptom_resolution.tsv".format(result_dir), sep="\t", index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Symptom co-occurrence, change and resolution tables.")
+    parser.add_argument("data", nargs="?", default="npadata_race.csv")
+    parser.add_argument("--out", default="results_symptom_sets")
+    args = parser.parse_args()
+
+    from npa_new import load_data, build_adf
+
+    adf = build_adf(load_data(args.data))
+    write_symptom_report(SymptomSets.from_frame(adf), adf, args.out)